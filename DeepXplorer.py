@@ -2,12 +2,12 @@
 
 from h5xplorer.h5xplorer import h5xplorer
 import menu
-import glob
-import shutil
+from export_cache import ExportCache
 
-app = h5xplorer(menu.context_menu,extended_selection=False)
+# the background tasks spawn processes that re-import this file
+if __name__ == '__main__':
 
-# clear
-# dirs = glob.glob('./_tmp_*')
-# for d in dirs:
-#     shutil.rmtree(d)
\ No newline at end of file
+    # keep the export directory within its disk budget
+    ExportCache('./_tmp_h5x/').evict()
+
+    app = h5xplorer(menu.context_menu,extended_selection=False)
\ No newline at end of file
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+import numpy as np
+import h5py
+import viztools
+
+# files bundled with the repository
+EXAMPLE_FILES = ['epoch.hdf5','epoch_data.hdf5','haddockScoreBM4.hdf5']
+
+# modules of the startup, h5xplorer alone is the reference
+IMPORT_MODULES = ['h5xplorer.h5xplorer','viztools','menu']
+
+# dependencies that should only be loaded by the actions using them
+HEAVY_MODULES = ['torch','deeprank','pdb2sql']
+
+def measure(func,*args,**kwargs):
+
+    """Run func once and return (elapsed time in sec, peak memory in MB).
+
+    The peak memory is the one seen by tracemalloc, which includes the
+    numpy buffers.
+    """
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    func(*args,**kwargs)
+    elapsed = time.perf_counter()-t0
+    _,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak/1024**2
+
+class _Item(object):
+    """Tree item as seen by the data preparation of the menu."""
+    def __init__(self,data_file,name):
+        self.data_file = data_file
+        self.name = name
+
+#
+# synthetic inputs
+#
+
+def make_grid(npts):
+    return {'x':np.linspace(0,npts-1,npts),
+            'y':np.linspace(0,npts-1,npts),
+            'z':np.linspace(0,npts-1,npts)}
+
+def _pdb_lines(nres):
+
+    # two facing chains of backbone atoms
+    lines, iatom = [], 1
+    for ichain,chain in enumerate(['A','B']):
+        for ires in range(nres):
+            for iname,name in enumerate(['N','CA','C','O']):
+                x,y,z = 1.5*ires + 0.3*iname, 4.*ichain, 0.5*iname
+                lines.append('ATOM  %5d  %-3s ALA %1s%4d    %8.3f%8.3f%8.3f  1.00  0.00           %1s'
+                             %(iatom,name,chain,ires+1,x,y,z,name[0]))
+                iatom += 1
+    return np.array(lines,dtype='S')
+
+def make_molecule_file(fname,npts,nfeat,sparse_frac=0.05,nres=50):
+
+    """Molecule with mapped features (half of them sparse) and raw features."""
+
+    rng = np.random.default_rng(0)
+    with h5py.File(fname,'w') as f5:
+        molgrp = f5.create_group('complex/mol')
+        molgrp.attrs['type'] = 'molecule'
+        molgrp['complex'] = _pdb_lines(nres)
+        for k,v in make_grid(npts).items():
+            molgrp['grid_points/'+k] = v
+        molgrp['grid_points/center'] = np.array([npts/2]*3)
+
+        for i in range(nfeat):
+            subgrp = molgrp.create_group('mapped_features/Feature_ind/feat_%03d' %i)
+            if i % 2 == 0:
+                subgrp.attrs['sparse'] = False
+                subgrp['value'] = rng.random((npts,npts,npts))
+            else:
+                nval = int(sparse_frac*npts**3)
+                subgrp.attrs['sparse'] = True
+                subgrp['index'] = rng.choice(npts**3,nval,replace=False)
+                subgrp['value'] = rng.random(nval)
+
+            # (chain,x,y,z,value)
+            natom = 4*nres
+            raw = np.column_stack([rng.integers(0,2,natom),rng.random((natom,3))*npts,rng.random(natom)])
+            molgrp['features/feat_%03d' %i] = raw
+
+    return fname
+
+def make_epoch_file(fname,nepoch,ndecoys):
+
+    """Regression epochs with hits, targets and outputs and their losses."""
+
+    rng = np.random.default_rng(0)
+    nsplit = {'train':ndecoys,'valid':ndecoys//4,'test':ndecoys//4}
+    with h5py.File(fname,'w') as f5:
+        for iepoch in range(nepoch):
+            grp = f5.create_group('epoch_%04d' %iepoch)
+            grp.attrs['type'] = 'epoch'
+            grp.attrs['task'] = 'reg'
+            for split,n in nsplit.items():
+                targets = rng.random(n)
+                grp[split+'/targets'] = targets
+                grp[split+'/outputs'] = targets + 0.1*rng.standard_normal(n)
+                grp[split+'/hit'] = (rng.random(n) < 0.1).astype(np.int64)
+
+        losses = f5.create_group('losses')
+        losses.attrs['type'] = 'losses'
+        for split in nsplit:
+            losses[split] = rng.random(nepoch)
+
+    return fname
+
+#
+# benchmarks
+#
+
+def bench_export_cube_files(npts,nfeat):
+
+    grid = make_grid(npts)
+    data_dict = {'feat_%03d' %i : np.random.rand(npts,npts,npts) for i in range(nfeat)}
+
+    export_path = tempfile.mkdtemp() + '/'
+    result = measure(viztools.export_cube_files,data_dict,grid,export_path)
+    shutil.rmtree(export_path)
+    return result
+
+def bench_get_points(mol_file):
+    with h5py.File(mol_file,'r') as f5:
+        return measure(viztools.get_points,f5['complex/mol'])
+
+def bench_get_feature(mol_file):
+    with h5py.File(mol_file,'r') as f5:
+        return measure(viztools.get_feature,f5['complex/mol'])
+
+def bench_map_feature(mol_file,npts):
+    with h5py.File(mol_file,'r') as f5:
+        return measure(viztools.map_feature,f5['complex/mol'],grid=make_grid(npts))
+
+def _epoch_paths(f5):
+    return sorted(f5[k].name for k in f5.keys() if f5[k].attrs.get('type',None) == 'epoch')
+
+def _has_hits(f5):
+    paths = _epoch_paths(f5)
+    return len(paths) > 0 and 'hit' in f5[paths[0]+'/train']
+
+def bench_epoch_metric(epoch_file,metric):
+
+    # one epoch at a time as done by the best epoch ranking
+    import metrics
+    with h5py.File(epoch_file,'r') as f5:
+        if not _has_hits(f5):
+            return None
+        def _per_epoch():
+            for path in _epoch_paths(f5):
+                metrics.epoch_scores(f5,path,metric)
+        return measure(_per_epoch)
+
+def bench_multi_epoch_metric(epoch_file,metric):
+
+    # all the epochs at once with an empty sidecar
+    import metrics
+    with h5py.File(epoch_file,'r') as f5:
+        if not _has_hits(f5):
+            return None
+        sidecar = tempfile.mktemp(suffix='.metrics.hdf5')
+        engine = metrics.MetricEngine(f5,sidecar=sidecar)
+        def _multi_epoch():
+            for split in ['train','valid','test']:
+                engine.compute(_epoch_paths(f5),split,metric)
+        result = measure(_multi_epoch)
+        if os.path.isfile(sidecar):
+            os.remove(sidecar)
+        return result
+
+def bench_bootstrap(epoch_file,metric):
+
+    # confidence bands of all the epochs with an empty sidecar
+    import metrics
+    with h5py.File(epoch_file,'r') as f5:
+        if not _has_hits(f5):
+            return None
+        sidecar = tempfile.mktemp(suffix='.metrics.hdf5')
+        engine = metrics.MetricEngine(f5,sidecar=sidecar)
+        result = measure(engine.compute_ci,_epoch_paths(f5),'train',metric)
+        if os.path.isfile(sidecar):
+            os.remove(sidecar)
+        return result
+
+def bench_losses(epoch_file):
+    import menu
+    with h5py.File(epoch_file,'r') as f5:
+        if 'losses' not in f5:
+            return None
+        return measure(menu._losses_values,_Item(f5,'/losses'))
+
+def bench_scatter(epoch_file,mode):
+
+    # the scatter plot is only for the regression epochs
+    import menu
+    with h5py.File(epoch_file,'r') as f5:
+        paths = _epoch_paths(f5)
+        if len(paths) == 0 or f5[paths[-1]].attrs.get('task','reg') != 'reg':
+            return None
+        return measure(menu._epoch_scatter,_Item(f5,paths[-1]),mode)
+
+def bench_import(module):
+
+    # cold import in a new interpreter
+    code  = "import sys,time,tracemalloc\n"
+    code += "tracemalloc.start()\nt0 = time.perf_counter()\n"
+    code += "import %s\n" %module
+    code += "print(time.perf_counter()-t0,tracemalloc.get_traced_memory()[1]/1024**2)\n"
+    code += "print(' '.join(m for m in %r if m in sys.modules))\n" %HEAVY_MODULES
+    proc = subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().split('\n')[-1])
+
+    # the last two lines are the timing and the heavy modules loaded
+    timing, loaded = proc.stdout.split('\n')[-3:-1]
+    elapsed, peak = map(float,timing.split())
+    if len(loaded) > 0:
+        print('-- import %s loads %s' %(module,loaded))
+    return elapsed, peak
+
+def run(name,func,*args):
+
+    """Run a benchmark, print and return its result.
+
+    A failing benchmark is reported with its traceback and the suite goes
+    on, the result is then {'name','error'}.
+    """
+
+    try:
+        result = func(*args)
+    except ImportError as inst:
+        print('%-50s : skipped (%s)' %(name,inst))
+        return None
+    except Exception as inst:
+        print('%-50s : failed (%s : %s)' %(name,type(inst).__name__,inst))
+        traceback.print_exc()
+        return {'name':name,'error':'%s : %s' %(type(inst).__name__,inst)}
+    if result is None:
+        print('%-50s : skipped (no data)' %name)
+        return None
+    elapsed, peak = result
+    print('%-50s : %8.3f sec %9.1f MB' %(name,elapsed,peak))
+    return {'name':name,'time':elapsed,'peak_mb':peak}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time the hot paths of DeepXplorer')
+    parser.add_argument('--npts',type=int,nargs='+',default=[30,60],help='number of grid points per axis')
+    parser.add_argument('--nfeat',type=int,default=10,help='number of features to export')
+    parser.add_argument('--nepoch',type=int,nargs='+',default=[50,500],help='number of synthetic epochs')
+    parser.add_argument('--ndecoys',type=int,default=1000,help='number of decoys per synthetic epoch')
+    parser.add_argument('--only',nargs='+',default=None,help='run only the benchmarks containing these words')
+    parser.add_argument('--json',default=None,help='append the results to this JSON-lines file')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    benchmarks = []
+
+    # startup
+    for module in IMPORT_MODULES:
+        benchmarks.append(('import %s' %module,bench_import,module))
+
+    # grids
+    for npts in args.npts:
+        tag = '%4d^3 x %3d features' %(npts,args.nfeat)
+        mol_file = make_molecule_file(os.path.join(tmpdir,'mol_%d.hdf5' %npts),npts,args.nfeat)
+        benchmarks.append(('export_cube_files ' + tag,bench_export_cube_files,npts,args.nfeat))
+        benchmarks.append(('get_points ' + tag,bench_get_points,mol_file))
+        benchmarks.append(('get_feature ' + tag,bench_get_feature,mol_file))
+        benchmarks.append(('map_feature ' + tag,bench_map_feature,mol_file,npts))
+
+    # epochs of the bundled files and synthetic ones
+    epoch_files = [(f,f) for f in EXAMPLE_FILES if os.path.isfile(f)]
+    for nepoch in args.nepoch:
+        epoch_files.append(('%d epochs x %d decoys' %(nepoch,args.ndecoys),
+                            make_epoch_file(os.path.join(tmpdir,'epoch_%d.hdf5' %nepoch),nepoch,args.ndecoys)))
+
+    for tag,epoch_file in epoch_files:
+        for metric in ['hitrate','avprec']:
+            benchmarks.append(('%s per epoch %s' %(metric,tag),bench_epoch_metric,epoch_file,metric))
+            benchmarks.append(('%s all epochs %s' %(metric,tag),bench_multi_epoch_metric,epoch_file,metric))
+            benchmarks.append(('%s bootstrap %s' %(metric,tag),bench_bootstrap,epoch_file,metric))
+        benchmarks.append(('losses %s' %tag,bench_losses,epoch_file))
+        for mode in ['scatter','sample','hist']:
+            benchmarks.append(('scatter (%s) %s' %(mode,tag),bench_scatter,epoch_file,mode))
+
+    results = []
+    for name,func,*fargs in benchmarks:
+        if args.only is None or any(w in name for w in args.only):
+            res = run(name,func,*fargs)
+            if res is not None:
+                results.append(res)
+
+    shutil.rmtree(tmpdir)
+
+    # keep track of the results over time
+    if args.json is not None:
+        with open(args.json,'a') as f:
+            for res in results:
+                res['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                f.write(json.dumps(res) + '\n')
+
+    # the suite only passes if all the benchmarks ran
+    failed = [res['name'] for res in results if 'error' in res]
+    if len(failed) > 0:
+        print('-- %d benchmarks failed : %s' %(len(failed),', '.join(failed)))
+        raise SystemExit(1)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import os
+import json
+import shutil
+import numpy as np
+import h5py
+from h5index import get_index
+
+SPLITS = ['train','valid','test']
+
+# columns of the epochs (the hits are not stored by all the trainings)
+COLUMNS = ['targets','outputs','hit']
+
+# number of rows read at once
+CHUNK_ROWS = 2**18
+
+def _version(fname):
+    stat = os.stat(os.path.abspath(fname))
+    return '%d_%d' %(stat.st_mtime_ns,stat.st_size)
+
+def _layout(h5file, epoch_paths):
+
+    # rows of each (epoch,split) and shape/dtype of the columns from the metadata only
+    blocks, columns = [], {}
+    for iepoch,path in enumerate(epoch_paths):
+        for isplit,split in enumerate(SPLITS):
+            grp_path = path.rstrip('/') + '/' + split
+            if grp_path not in h5file or 'targets' not in h5file[grp_path]:
+                continue
+            grp = h5file[grp_path]
+            blocks.append((iepoch,isplit,grp_path,grp['targets'].shape[0]))
+            for col in COLUMNS:
+                if col not in grp:
+                    continue
+                dset = grp[col]
+                shape, dtype = dset.shape[1:], dset.dtype
+                if col in columns:
+                    if columns[col][0] != shape:
+                        raise ValueError('%s of %s has the shape %s, %s expected' %(col,grp_path,shape,columns[col][0]))
+                    dtype = np.result_type(columns[col][1],dtype)
+                columns[col] = (shape,dtype)
+    return blocks, columns
+
+def _dtypes(h5file, blocks, columns):
+
+    # one dtype per column for all the blocks, the missing values are nan
+    dtypes = {}
+    for col,(shape,dtype) in columns.items():
+        if dtype.kind in 'iub' and any(col not in h5file[b[2]] for b in blocks):
+            dtype = np.dtype(np.float64)
+        dtypes[col] = dtype
+    return dtypes
+
+def _chunks(grp, col, nrows):
+    # rows of a column read by chunks, nan for the splits without this column
+    for istart in range(0,nrows,CHUNK_ROWS):
+        istop = min(istart+CHUNK_ROWS,nrows)
+        if col in grp:
+            yield istart, istop, grp[col][istart:istop]
+        else:
+            yield istart, istop, None
+
+def _losses(h5file):
+
+    # (run,epoch,train,valid,test) table of all the losses groups
+    # the run is the group holding the losses ('/' for a single training)
+    paths = get_index(h5file).find(type='losses')
+    if len(paths) == 0:
+        return None
+
+    runs = [os.path.dirname(p.rstrip('/')) for p in paths]
+    width = max(len(r) for r in runs)
+    tables = []
+    for run,path in zip(runs,paths):
+        grp = h5file[path]
+        nepoch = max([grp[s].shape[0] for s in SPLITS if s in grp] + [0])
+        table = np.zeros(nepoch,dtype=[('run','U%d' %width),('epoch','i4')] + [(s,'f8') for s in SPLITS])
+        table['run'] = run
+        table['epoch'] = np.arange(nepoch)
+        for s in SPLITS:
+            table[s] = np.nan
+            if s in grp:
+                table[s][:grp[s].shape[0]] = grp[s][()]
+        tables.append(table)
+    return np.concatenate(tables)
+
+def export_npy(h5file, outdir):
+
+    """Write the epochs of the file in one .npy file per column.
+
+    The rows of all the epochs and splits are concatenated; the epoch and
+    split columns give the key of each row and index.json the rows of each
+    (epoch,split). The columns are written epoch by epoch, by chunks, in
+    files memory mapped on disk so that the memory stays bounded.
+    """
+
+    epoch_paths = get_index(h5file).find(type='epoch')
+    blocks, columns = _layout(h5file,epoch_paths)
+    nrows = sum(b[3] for b in blocks)
+
+    tmpdir = outdir.rstrip('/') + '.part'
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    def _open(name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(tmpdir,name + '.npy'),mode='w+',dtype=dtype,shape=shape)
+
+    epoch = _open('epoch',(nrows,),np.int32)
+    split = _open('split',(nrows,),np.int8)
+    dtypes = _dtypes(h5file,blocks,columns)
+    data = {}
+    for col,(shape,_) in columns.items():
+        data[col] = _open(col,(nrows,)+shape,dtypes[col])
+
+    index, offset = [], 0
+    for iepoch,isplit,grp_path,n in blocks:
+        grp = h5file[grp_path]
+        epoch[offset:offset+n] = iepoch
+        split[offset:offset+n] = isplit
+        for col in data:
+            for istart,istop,values in _chunks(grp,col,n):
+                data[col][offset+istart:offset+istop] = np.nan if values is None else values
+        index.append({'epoch':epoch_paths[iepoch],'split':SPLITS[isplit],'start':offset,'stop':offset+n})
+        offset += n
+
+    for arr in [epoch,split] + list(data.values()):
+        arr.flush()
+    del epoch, split, data
+
+    losses = _losses(h5file)
+    if losses is not None:
+        np.save(os.path.join(tmpdir,'losses.npy'),losses)
+
+    with open(os.path.join(tmpdir,'index.json'),'w') as f:
+        json.dump({'source':os.path.abspath(h5file.filename),'version':_version(h5file.filename),'format':'npy',
+                   'epochs':epoch_paths,'splits':SPLITS,'blocks':index},f)
+
+    if os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    os.replace(tmpdir,outdir)
+    return outdir
+
+def export_parquet(h5file, outdir):
+
+    """Write the epochs of the file in epochs.parquet (and losses.parquet).
+
+    One row group is written per chunk of (epoch,split) rows. The outputs
+    of the classification are split in output_0, output_1 ... columns.
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    epoch_paths = get_index(h5file).find(type='epoch')
+    blocks, columns = _layout(h5file,epoch_paths)
+
+    tmpdir = outdir.rstrip('/') + '.part'
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    # all the row groups have the same schema
+    dtypes = _dtypes(h5file,blocks,columns)
+
+    writer = None
+    for iepoch,isplit,grp_path,n in blocks:
+        grp = h5file[grp_path]
+        chunks = {col:_chunks(grp,col,n) for col in columns}
+        for istart in range(0,n,CHUNK_ROWS):
+            table = {'epoch':np.full(min(CHUNK_ROWS,n-istart),epoch_paths[iepoch].strip('/')),
+                     'split':np.full(min(CHUNK_ROWS,n-istart),SPLITS[isplit])}
+            for col,(shape,dtype) in columns.items():
+                _,istop,values = next(chunks[col])
+                if values is None:
+                    values = np.full((istop-istart,)+shape,np.nan)
+                values = np.asarray(values).astype(dtypes[col],copy=False)
+                if len(shape) == 0:
+                    table[col] = values
+                else:
+                    for k in range(shape[0]):
+                        table['%s_%d' %(col.rstrip('s'),k)] = values[:,k]
+            table = pa.table(table)
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(tmpdir,'epochs.parquet'),table.schema)
+            writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+    losses = _losses(h5file)
+    if losses is not None:
+        pq.write_table(pa.table({k:losses[k] for k in losses.dtype.names}),os.path.join(tmpdir,'losses.parquet'))
+
+    with open(os.path.join(tmpdir,'index.json'),'w') as f:
+        json.dump({'source':os.path.abspath(h5file.filename),'version':_version(h5file.filename),'format':'parquet',
+                   'epochs':epoch_paths,'splits':SPLITS},f)
+
+    if os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    os.replace(tmpdir,outdir)
+    return outdir
+
+EXPORTS = {'npy':export_npy,'parquet':export_parquet}
+
+def is_stale(h5file, outdir, fmt='npy'):
+    fname = os.path.join(outdir,'index.json')
+    if not os.path.isfile(fname):
+        return True
+    with open(fname) as f:
+        index = json.load(f)
+    return index['version'] != _version(h5file.filename) or index.get('format',None) != fmt
+
+def export_epochs(h5file, outdir=None, fmt='npy'):
+
+    """Export the epochs of the file if they changed since the last export."""
+
+    if outdir is None:
+        outdir = os.path.splitext(h5file.filename)[0] + '_columns'
+    if is_stale(h5file,outdir,fmt):
+        EXPORTS[fmt](h5file,outdir)
+    return outdir
+
+def load_columns(outdir):
+
+    """Memory mapped columns of an .npy export and its index.
+
+    Return {column : array} with the epoch and split codes, the data columns,
+    the losses table and the index {'epochs','splits','blocks'}.
+    """
+
+    columns = {}
+    for fname in os.listdir(outdir):
+        if fname.endswith('.npy'):
+            columns[fname[:-4]] = np.load(os.path.join(outdir,fname),mmap_mode='r')
+    with open(os.path.join(outdir,'index.json')) as f:
+        columns['index'] = json.load(f)
+    return columns
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Export the epochs of a deeprank HDF5 file in a columnar format')
+    parser.add_argument('hdf5',help='deeprank HDF5 file')
+    parser.add_argument('-o','--output',default=None,help='output directory (default <file>_columns)')
+    parser.add_argument('--format',default='npy',choices=list(EXPORTS),help='memory mappable .npy columns or parquet')
+    args = parser.parse_args()
+
+    with h5py.File(args.hdf5,'r') as f5:
+        outdir = args.output or os.path.splitext(args.hdf5)[0] + '_columns'
+        EXPORTS[args.format](f5,outdir)
+    print('-- Epochs exported in %s' %outdir)
@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import hashlib
+
+# default disk budget of the cache in MB
+DEFAULT_CACHE_SIZE = 2048
+
+class ExportCache(object):
+
+    def __init__(self, root='./_tmp_h5x/', max_size=None):
+        """Cache of the files exported for the viewers.
+
+        Each entry is a directory keyed by the source file, the group path,
+        the version of the source file (mtime and size) and the export
+        parameters. The least recently used entries are removed when the total
+        size of the cache exceeds max_size (in MB, default to
+        $DEEPXPLORER_CACHE_SIZE or 2048).
+        """
+
+        self.root = root
+        if max_size is None:
+            max_size = float(os.environ.get('DEEPXPLORER_CACHE_SIZE',DEFAULT_CACHE_SIZE))
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(fname, grp_path, params=None):
+
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        version = '%d_%d' %(stat.st_mtime_ns,stat.st_size)
+        params = json.dumps(params,sort_keys=True)
+        key = hashlib.sha1(('%s:%s:%s:%s' %(fname,grp_path,version,params)).encode()).hexdigest()
+        return key, {'source':fname,'group':grp_path,'version':version,'params':params}
+
+    def get_dir(self, mol_name, molgrp, params=None):
+
+        key, info = self.get_key(molgrp.file.filename,molgrp.name,params)
+
+        # keep the molecule name for readability
+        outdir = os.path.join(self.root,'%s_%s' %(mol_name,key[:16])) + '/'
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir,exist_ok=True)
+            with open(outdir + '.cache.json','w') as f:
+                json.dump(info,f)
+
+        self.touch(outdir)
+        return outdir
+
+    @staticmethod
+    def touch(outdir):
+        fname = os.path.join(outdir,'.cache.json')
+        if os.path.isfile(fname):
+            os.utime(fname,None)
+
+    @staticmethod
+    def _last_access(outdir):
+        fname = os.path.join(outdir,'.cache.json')
+        if os.path.isfile(fname):
+            return os.path.getmtime(fname)
+        return os.path.getmtime(outdir)
+
+    @staticmethod
+    def _dir_size(outdir):
+        size = 0
+        for dirpath, _, filenames in os.walk(outdir):
+            for f in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath,f))
+                except OSError:
+                    pass
+        return size
+
+    def entries(self):
+
+        if not os.path.isdir(self.root):
+            return []
+
+        entries = []
+        for name in os.listdir(self.root):
+            outdir = os.path.join(self.root,name) + '/'
+            if os.path.isdir(outdir):
+                entries.append((self._last_access(outdir),self._dir_size(outdir),outdir))
+        return entries
+
+    def size(self):
+        return sum(e[1] for e in self.entries())/1024.**2
+
+    def evict(self, keep=()):
+
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        budget = self.max_size*1024**2
+        keep = [os.path.abspath(k) for k in keep]
+
+        # remove the least recently used entries first
+        for _, size, outdir in entries:
+            if total <= budget:
+                break
+            if os.path.abspath(outdir) in keep:
+                continue
+            print('-- Evict %s from cache' %outdir)
+            shutil.rmtree(outdir,ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, outdir in self.entries():
+            shutil.rmtree(outdir,ignore_errors=True)
@@ -0,0 +1,297 @@
+import os
+import threading
+import numpy as np
+import h5py
+from h5index import get_index
+import gridmap
+
+# maximum number of bins of the histograms
+NBINS = 256
+
+# number of values read at once
+CHUNK_SIZE = 2**20
+
+class StreamingHistogram(object):
+
+    def __init__(self, nbins=NBINS):
+        """Histogram of values seen chunk by chunk.
+
+        The bins have a width of 2**scale and are aligned on 0, so when the
+        values don't fit in nbins anymore the width is doubled by merging the
+        bins two by two, without reading the data again.
+        """
+
+        self.nbins = nbins
+        self.scale = None
+        self.start = 0
+        self.counts = np.zeros(0,dtype=np.int64)
+
+    @property
+    def width(self):
+        return 2.**self.scale
+
+    def edges(self):
+        return (self.start + np.arange(len(self.counts)+1))*self.width
+
+    def _coarsen(self):
+        index = (self.start + np.arange(len(self.counts)))//2
+        start = self.start//2
+        self.counts = np.bincount(index-start,weights=self.counts).astype(np.int64)
+        self.start = start
+        self.scale += 1
+
+    def add(self, values, nzeros=0):
+
+        values = np.asarray(values,dtype=np.float64).ravel()
+        if len(values) == 0 and nzeros == 0:
+            return
+
+        lo = min([values.min()] if len(values) > 0 else [0.])
+        hi = max([values.max()] if len(values) > 0 else [0.])
+        if nzeros > 0:
+            lo, hi = min(lo,0.), max(hi,0.)
+
+        # initial width from the first values
+        if self.scale is None:
+            span = hi-lo
+            if span > 0:
+                self.scale = int(np.ceil(np.log2(span/self.nbins)))
+            else:
+                self.scale = int(np.floor(np.log2(max(abs(hi),2.**-30)))) - 8
+            self.start = int(np.floor(lo/self.width))
+
+        # range of bins covering the old and new values
+        while True:
+            first = int(np.floor(lo/self.width))
+            last = int(np.floor(hi/self.width))
+            if len(self.counts) > 0:
+                first = min(first,self.start)
+                last = max(last,self.start+len(self.counts)-1)
+            if last-first+1 <= self.nbins:
+                break
+            self._coarsen()
+
+        counts = np.zeros(last-first+1,dtype=np.int64)
+        counts[self.start-first:self.start-first+len(self.counts)] = self.counts
+        index = np.floor(values/self.width).astype(np.int64) - first
+        counts += np.bincount(index,minlength=len(counts))
+        if nzeros > 0:
+            counts[-first] += nzeros
+
+        self.counts = counts
+        self.start = first
+
+    def quantile(self, q):
+
+        """Approximate quantile, interpolated within the bins."""
+
+        total = self.counts.sum()
+        if total == 0:
+            return np.nan
+        cum = np.concatenate([[0],np.cumsum(self.counts)])/total
+        return float(np.interp(q,cum,self.edges()))
+
+class FeatureStats(object):
+
+    def __init__(self, nbins=NBINS):
+        """Summary statistics of a feature accumulated chunk by chunk."""
+
+        self.n = 0
+        self.nnz = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.hist = StreamingHistogram(nbins)
+
+    def _merge(self, n, mean, m2):
+        # combine the moments of two sets of values (Chan et al.)
+        ntot = self.n + n
+        delta = mean - self.mean
+        self.mean += delta*n/ntot
+        self.m2 += m2 + delta**2*self.n*n/ntot
+        self.n = ntot
+
+    def add(self, values, nzeros=0):
+
+        """Add the values of a chunk and nzeros implicit zeros (sparse grids)."""
+
+        values = np.asarray(values,dtype=np.float64).ravel()
+        if len(values) > 0:
+            mean = values.mean()
+            self._merge(len(values),mean,np.sum((values-mean)**2))
+            self.nnz += np.count_nonzero(values)
+            self.min = min(self.min,values.min())
+            self.max = max(self.max,values.max())
+        if nzeros > 0:
+            self._merge(nzeros,0.,0.)
+            self.min = min(self.min,0.)
+            self.max = max(self.max,0.)
+        self.hist.add(values,nzeros)
+
+    def summary(self):
+        if self.n == 0:
+            return {'n':0,'min':np.nan,'max':np.nan,'mean':np.nan,'std':np.nan,'sparsity':np.nan}
+        return {'n':self.n,'min':self.min,'max':self.max,'mean':self.mean,
+                'std':np.sqrt(self.m2/self.n),'sparsity':1.-self.nnz/self.n}
+
+def _feature_chunks(subgrp, shape):
+
+    # yield (values,nzeros) chunks of a mapped feature
+    dset = subgrp['value']
+    if subgrp.attrs['sparse']:
+        nval = dset.shape[0]
+        for istart in range(0,nval,CHUNK_SIZE):
+            yield dset[istart:istart+CHUNK_SIZE], 0
+        yield np.zeros(0), int(np.prod(shape)) - nval
+    else:
+        nrows = max(1,CHUNK_SIZE//max(1,int(np.prod(dset.shape[1:]))))
+        for istart in range(0,dset.shape[0],nrows):
+            yield dset[istart:istart+nrows], 0
+
+def _downsampled(subgrp, shape, factor, mode):
+
+    # coarser grid of a mapped feature as exported for the previews
+    if subgrp.attrs['sparse']:
+        return gridmap.downsample_sparse(subgrp['index'][()],subgrp['value'][()],shape,factor,mode)
+    return gridmap.downsample(subgrp['value'][()],factor,mode)
+
+class FeatureIndex(object):
+
+    def __init__(self, h5file, sidecar=None, nbins=NBINS, lod_levels=(), lod_mode='mean'):
+        """Statistics and histograms of the mapped features over all the molecules.
+
+        All the features are computed in one pass over the file and stored in
+        a sidecar file (by default <file>.features.hdf5) under the level of
+        detail and the feature name (e.g. lod1/AtomicDensities_ind/C_chain1).
+        The coarser levels lod_levels are the grids downsampled as for the
+        previews (see gridmap.downsample). The sidecar is cleared when the
+        source file changes. If the sidecar can't be written the index is
+        only kept in memory.
+        """
+
+        self.h5file = h5file
+        self.nbins = nbins
+        fname = os.path.abspath(h5file.filename)
+        if sidecar is None:
+            sidecar = os.path.splitext(fname)[0] + '.features.hdf5'
+        self.sidecar = sidecar
+
+        stat = os.stat(fname)
+        self.lods = (1,) + tuple(lod_levels)
+        self.lod_mode = lod_mode
+        self.version = '%d_%d_lod%s_%s' %(stat.st_mtime_ns,stat.st_size,'-'.join(map(str,self.lods)),lod_mode)
+
+        self.memory = None
+        self.lock = threading.Lock()
+
+    def _read_sidecar(self):
+        try:
+            with h5py.File(self.sidecar,'r') as f5:
+                if f5.attrs.get('version',None) != self.version:
+                    return None
+                stats = {lod:{} for lod in self.lods}
+                def _read(name,obj):
+                    if isinstance(obj,h5py.Dataset):
+                        lod, name = os.path.dirname(name).split('/',1)
+                        stats[int(lod[3:])][name] = self._from_h5(obj)
+                f5.visititems(_read)
+                return stats
+        except (OSError,IOError):
+            return None
+
+    def _from_h5(self, dset):
+        st = FeatureStats(self.nbins)
+        for k in ['n','nnz','mean','m2','min','max']:
+            setattr(st,k,dset.attrs[k])
+        st.hist.counts = dset[()]
+        st.hist.scale = int(dset.attrs['scale'])
+        st.hist.start = int(dset.attrs['start'])
+        return st
+
+    def _write_sidecar(self, stats):
+        try:
+            with h5py.File(self.sidecar,'w') as f5:
+                f5.attrs['version'] = self.version
+                for lod in self.lods:
+                    for name,st in stats[lod].items():
+                        dset = f5.create_dataset('lod%d/%s/counts' %(lod,name),data=st.hist.counts)
+                        for k in ['n','nnz','mean','m2','min','max']:
+                            dset.attrs[k] = getattr(st,k)
+                        dset.attrs['scale'] = st.hist.scale if st.hist.scale is not None else 0
+                        dset.attrs['start'] = st.hist.start
+        except (OSError,IOError):
+            print('-- Feature statistics of %s are not cached on disk' %self.h5file.filename)
+
+    def scan(self):
+
+        """Read all the mapped features of all the molecules once."""
+
+        stats = {lod:{} for lod in self.lods}
+        for path in get_index(self.h5file).find(type='molecule',has='mapped_features'):
+            molgrp = self.h5file[path]
+            shape = tuple(len(molgrp['grid_points/'+k]) for k in 'xyz')
+            mapgrp = molgrp['mapped_features']
+            for data_name in mapgrp.keys():
+                for ff in mapgrp[data_name].keys():
+                    name = data_name + '/' + ff
+                    for lod in self.lods:
+                        if name not in stats[lod]:
+                            stats[lod][name] = FeatureStats(self.nbins)
+                    subgrp = mapgrp[data_name][ff]
+                    for values,nzeros in _feature_chunks(subgrp,shape):
+                        stats[1][name].add(values,nzeros)
+                    for lod in self.lods[1:]:
+                        stats[lod][name].add(_downsampled(subgrp,shape,lod,self.lod_mode))
+        return stats
+
+    def build(self):
+        with self.lock:
+            if self.memory is None:
+                self.memory = self._read_sidecar()
+                if self.memory is None:
+                    self.memory = self.scan()
+                    self._write_sidecar(self.memory)
+        return self.memory
+
+    def cached(self):
+
+        """The statistics if they are in memory or in a current sidecar, None otherwise.
+
+        Unlike build the file is never scanned, for the callers that can do
+        without the statistics.
+        """
+
+        with self.lock:
+            if self.memory is None:
+                self.memory = self._read_sidecar()
+        return self.memory
+
+    def names(self):
+        return sorted(self.build()[1].keys())
+
+    def get(self, name, lod=1):
+
+        """Summary statistics of a feature and its histogram (counts,edges)."""
+
+        st = self.build()[lod][name]
+        out = st.summary()
+        out['counts'] = st.hist.counts
+        out['edges'] = st.hist.edges() if st.hist.scale is not None else np.zeros(1)
+        return out
+
+    def quantile(self, name, q, lod=1):
+        return self.build()[lod][name].hist.quantile(q)
+
+
+# one index per opened file
+_feature_indexes = {}
+
+def get_feature_index(h5file, lod_levels=(), lod_mode='mean'):
+
+    index = _feature_indexes.get(h5file.filename,None)
+    lods = (1,) + tuple(lod_levels)
+    if index is None or index.h5file != h5file or index.lods != lods or index.lod_mode != lod_mode:
+        index = FeatureIndex(h5file,lod_levels=lod_levels,lod_mode=lod_mode)
+        _feature_indexes[h5file.filename] = index
+    return index
@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from concurrent import futures
+
+# same kernels and cutoffs as deeprank.learn.DataSet._densgrid and _featgrid
+# (the mapping of the unmapped molecules used before), the feature kernel of
+# DataSet has a fixed width in Angstrom that does not depend on the resolution
+
+def density_kernel(dd, vdw_radius):
+    inner = np.exp(-2*dd**2/vdw_radius**2)
+    outer = (4./np.e**2/vdw_radius**2*dd**2) - (12./np.e**2/vdw_radius*dd) + 9./np.e**2
+    return np.where(dd < vdw_radius,inner,np.where(dd < 1.5*vdw_radius,outer,0.))
+
+def density_cutoff(vdw_radius):
+    return 1.5*vdw_radius
+
+# sigma = sqrt(1/2), beta = 0.5/sigma**2
+FEATURE_BETA = 1.
+FEATURE_CUTOFF = 5.*FEATURE_BETA
+
+def feature_kernel(dd, value):
+    return np.where(dd < FEATURE_CUTOFF,value*np.exp(-FEATURE_BETA*dd),0.)
+
+def map_points(grid, pos, kernel, param, cutoff, chunk_size=2**22):
+
+    """Sum kernel(distance,param) of all the points pos on the grid.
+
+    The grid is regular so the grid points within the cutoff of an atom are a
+    small box of indexes around it. The distances are computed only on these
+    boxes, for many atoms at once, and accumulated on the grid with bincount.
+
+    Args:
+        grid (dict): axis of the grid {'x','y','z'}
+        pos (np.array): (natom,3) positions
+        kernel (callable): kernel(dd,param) with param (natom,1) or scalar
+        param (float or np.array): parameter of the kernel, per atom or not
+        cutoff (float): the kernel is zero beyond the cutoff
+    """
+
+    axes = [np.asarray(grid[k]) for k in 'xyz']
+    npts = tuple(len(a) for a in axes)
+    res = np.array([a[1]-a[0] for a in axes])
+    low = np.array([a[0] for a in axes])
+    strides = (npts[1]*npts[2],npts[2],1)
+
+    data = np.zeros(int(np.prod(npts)))
+    pos = np.asarray(pos,dtype=np.float64).reshape(-1,3)
+    if len(pos) == 0:
+        return data.reshape(npts)
+
+    # half width of the box around the atoms
+    half = np.ceil(cutoff/res).astype(int) + 1
+    width = 2*half+1
+
+    # the points outside of the grid are sent beyond the cutoff
+    far = (2.*cutoff)**2
+
+    param = np.broadcast_to(np.asarray(param,dtype=np.float64),(len(pos),)).reshape(-1,1,1,1)
+    nchunk = max(1,chunk_size//int(np.prod(width)))
+
+    for istart in range(0,len(pos),nchunk):
+
+        p = pos[istart:istart+nchunk]
+        center = np.rint((p-low)/res).astype(int)
+
+        # the distances and indexes are separable along the axis
+        d2, flat = [], []
+        for ax in range(3):
+            index = center[:,ax,None] + np.arange(-half[ax],half[ax]+1)[None,:]
+            inside = (index >= 0) & (index < npts[ax])
+            index = np.clip(index,0,npts[ax]-1)
+            d2.append(np.where(inside,(axes[ax][index]-p[:,ax,None])**2,far))
+            flat.append(index*strides[ax])
+
+        # distances computed from the grid coordinates as deeprank does
+        dd = np.sqrt(d2[0][:,:,None,None] + d2[1][:,None,:,None] + d2[2][:,None,None,:])
+        values = np.where(dd < cutoff,kernel(dd,param[istart:istart+nchunk]),0.)
+
+        flat = flat[0][:,:,None,None] + flat[1][:,None,:,None] + flat[2][:,None,None,:]
+        data += np.bincount(flat.ravel(),weights=values.ravel(),minlength=len(data))
+
+    return data.reshape(npts)
+
+def map_densities(grid, positions, vdw_radius):
+    return map_points(grid,positions,density_kernel,vdw_radius,density_cutoff(vdw_radius))
+
+def map_values(grid, positions, values):
+    return map_points(grid,positions,feature_kernel,values,FEATURE_CUTOFF)
+
+def map_many(jobs, nthreads=None):
+
+    """Run the mapping jobs [(name,func,args)] in a thread pool.
+
+    numpy releases the GIL in the heavy operations so the features are
+    mapped concurrently. Threads are used so that this also works inside
+    the worker processes of the batch export.
+    """
+
+    if nthreads is None:
+        nthreads = os.cpu_count()
+
+    with futures.ThreadPoolExecutor(nthreads) as pool:
+        results = {name:pool.submit(func,*args) for name,func,args in jobs}
+        return {name:fut.result() for name,fut in results.items()}
+
+#
+# coarser levels of the grids for the previews
+#
+
+def _block_counts(shape, factor):
+    # number of fine points in each block, the last block of an axis can be smaller
+    counts = [np.minimum(factor,n-factor*np.arange(-(-n//factor))) for n in shape]
+    return counts[0][:,None,None]*counts[1][None,:,None]*counts[2][None,None,:]
+
+def downsample_grid(grid, factor):
+
+    """Axis of the coarse grid, the centers of the blocks of factor^3 points."""
+
+    coarse = {}
+    for k in 'xyz':
+        x = np.asarray(grid[k])
+        res = x[1]-x[0]
+        coarse[k] = x[0] + res*(0.5*(factor-1) + factor*np.arange(-(-len(x)//factor)))
+    return coarse
+
+def downsample(values, factor, mode='mean'):
+
+    """Block average (mean) or max-pooling (max) of a dense grid.
+
+    The max-pooling keeps the value of largest magnitude of each block so
+    that the negative features are preserved too.
+    """
+
+    values = np.asarray(values)
+    shape = values.shape
+    nc = [-(-n//factor) for n in shape]
+    pad = [(0,c*factor-n) for c,n in zip(nc,shape)]
+    blocks = np.pad(values,pad).reshape(nc[0],factor,nc[1],factor,nc[2],factor)
+
+    if mode == 'mean':
+        return blocks.sum(axis=(1,3,5))/_block_counts(shape,factor)
+
+    blocks = blocks.transpose(0,2,4,1,3,5).reshape(nc[0],nc[1],nc[2],-1)
+    imax = np.argmax(np.abs(blocks),axis=-1)
+    return np.take_along_axis(blocks,imax[...,None],axis=-1)[...,0]
+
+def downsample_sparse(index, value, shape, factor, mode='mean'):
+
+    """Same as downsample for a sparse grid (flat or (n,3) index), without densifying it."""
+
+    index = np.asarray(index)
+    value = np.asarray(value,dtype=np.float64)
+    if index.ndim == 1:
+        index = np.stack(np.unravel_index(index,shape),axis=-1)
+    nc = tuple(-(-n//factor) for n in shape)
+    block = np.ravel_multi_index((index//factor).T,nc)
+
+    if mode == 'mean':
+        sums = np.bincount(block,weights=value,minlength=int(np.prod(nc)))
+        return sums.reshape(nc)/_block_counts(shape,factor)
+
+    # the value of largest magnitude of each block
+    out = np.zeros(int(np.prod(nc)))
+    order = np.lexsort((np.abs(value),block))
+    block, value = block[order], value[order]
+    last = np.append(block[1:] != block[:-1],True)
+    out[block[last]] = value[last]
+    return out.reshape(nc)
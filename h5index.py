@@ -0,0 +1,86 @@
+import h5py
+
+# attributes of the groups used by the menus
+INDEX_ATTRS = ['type','task','sparse']
+
+class H5Index(object):
+
+    def __init__(self, h5file, attrs=INDEX_ATTRS):
+        """In memory index of group path -> attributes of an opened HDF5 file.
+
+        The attributes of a group are read the first time they are needed and
+        then cached. The whole file is scanned once when we need to filter the
+        groups (e.g. all the epochs).
+        """
+
+        self.h5file = h5file
+        self.attrs = attrs
+        self.groups = {}
+        self.complete = False
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value,bytes):
+            return value.decode()
+        return value
+
+    def _read(self, grp):
+        return {k:self._decode(grp.attrs[k]) for k in self.attrs if k in grp.attrs}
+
+    def get(self, path, attr=None, default=None):
+
+        path = '/' + path.strip('/')
+        if path not in self.groups:
+            if self.complete or path not in self.h5file:
+                return default
+            self.groups[path] = self._read(self.h5file[path])
+
+        if attr is None:
+            return self.groups[path]
+        return self.groups[path].get(attr,default)
+
+    def build(self):
+
+        if self.complete:
+            return self
+
+        groups = {'/':self._read(self.h5file)}
+        def _visit(name,obj):
+            if isinstance(obj,h5py.Group):
+                groups['/'+name] = self._read(obj)
+        self.h5file.visititems(_visit)
+
+        self.groups = groups
+        self.complete = True
+        return self
+
+    def invalidate(self):
+        self.groups = {}
+        self.complete = False
+
+    def find(self, has=None, **attrs):
+
+        """Paths of the groups with the given attributes and subgroup.
+
+        e.g. index.find(type='epoch') or index.find(type='molecule',has='mapped_features')
+        """
+
+        self.build()
+        paths = []
+        for path, grp_attrs in self.groups.items():
+            if all(grp_attrs.get(k,None) == v for k,v in attrs.items()):
+                if has is None or path.rstrip('/') + '/' + has in self.groups:
+                    paths.append(path)
+        return sorted(paths)
+
+
+# one index per opened file
+_indexes = {}
+
+def get_index(h5file):
+
+    index = _indexes.get(h5file.filename,None)
+    if index is None or index.h5file != h5file:
+        index = H5Index(h5file)
+        _indexes[h5file.filename] = index
+    return index
@@ -0,0 +1,17 @@
+import numpy as np
+
+def as_array(dset):
+
+    """Numpy view of an HDF5 dataset for the console.
+
+    Contiguous and uncompressed datasets are memory mapped directly from the
+    file so that nothing is read or copied until the data is used. The other
+    ones (chunked, compressed, object dtype) are read once.
+    """
+
+    if dset.chunks is None and dset.dtype.kind not in 'OV' and dset.size > 0:
+        offset = dset.id.get_offset()
+        if offset is not None:
+            return np.memmap(dset.file.filename,dtype=dset.dtype,mode='r',offset=offset,shape=dset.shape)
+
+    return dset[()]
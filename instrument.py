@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import threading
+import traceback
+import cProfile
+from contextlib import contextmanager
+
+# log of the actions, enabled with DEEPXPLORER_TRACE=<file.jsonl> (or 1)
+TRACE_FILE = os.environ.get('DEEPXPLORER_TRACE','')
+if TRACE_FILE == '1':
+    TRACE_FILE = 'deepxplorer_trace.jsonl'
+
+# cProfile capture of each action, enabled with DEEPXPLORER_PROFILE=1
+PROFILE = os.environ.get('DEEPXPLORER_PROFILE','0') == '1'
+
+_state = {'enabled':TRACE_FILE != '','file':TRACE_FILE or 'deepxplorer_trace.jsonl','profile':PROFILE}
+_local = threading.local()
+_lock = threading.Lock()
+
+def enabled():
+    return _state['enabled']
+
+def set_enabled(flag, fname=None, profile=None):
+
+    """Switch the trace on or off (e.g. from the menu)."""
+
+    _state['enabled'] = flag
+    if fname is not None:
+        _state['file'] = fname
+    if profile is not None:
+        _state['profile'] = profile
+
+def settings():
+    return dict(_state)
+
+def _write(record):
+    line = json.dumps(record,default=str) + '\n'
+    with _lock:
+        with open(_state['file'],'a') as f:
+            f.write(line)
+
+@contextmanager
+def action(name, **info):
+
+    """Record the duration, the phases and the errors of an action.
+
+    The record is written as one JSON line in the trace file when the trace
+    is enabled. Exceptions are recorded with their traceback and raised
+    again. Nested actions of the same thread are recorded as phases.
+    """
+
+    if not _state['enabled'] or getattr(_local,'record',None) is not None:
+        with phase(name):
+            yield
+        return
+
+    record = {'action':name,'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+              'pid':os.getpid(),'thread':threading.current_thread().name,'phases':{}}
+    record.update(info)
+    _local.record = record
+
+    prof = None
+    if _state['profile']:
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # only one profiler can be active at a time
+            prof = None
+
+    t0 = time.perf_counter()
+    try:
+        yield
+        record['status'] = 'done'
+    except BaseException as inst:
+        record['status'] = 'failed'
+        record['error'] = '%s : %s' %(type(inst).__name__,inst)
+        record['traceback'] = traceback.format_exc()
+        raise
+    finally:
+        record['elapsed'] = time.perf_counter()-t0 - record.get('excluded',0.)
+        if prof is not None:
+            prof.disable()
+            fname = os.path.splitext(_state['file'])[0] + '_%d_%d.prof' %(os.getpid(),int(1000*time.time()))
+            prof.dump_stats(fname)
+            record['profile'] = fname
+        _local.record = None
+        _write(record)
+
+@contextmanager
+def phase(name):
+
+    """Add the time spent in the block to the phase of the current action."""
+
+    record = getattr(_local,'record',None)
+    if record is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['phases'][name] = record['phases'].get(name,0.) + time.perf_counter()-t0
+
+@contextmanager
+def excluded(name):
+
+    """Record the time spent in the block as a phase that is not counted in
+    the duration of the action (e.g. a menu waiting for the user)."""
+
+    record = getattr(_local,'record',None)
+    if record is None:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter()-t0
+        record['phases'][name] = record['phases'].get(name,0.) + dt
+        record['excluded'] = record.get('excluded',0.) + dt
+
+class Cancelled(Exception):
+    """Raised by progress() in a task cancelled from the menu."""
+
+def set_reporter(func):
+
+    """Send the progress of the task run by this thread to func(msg).
+
+    func raises Cancelled when the task has been cancelled. Set by the task
+    manager around each task, None outside of the tasks.
+    """
+
+    _local.reporter = func
+
+def progress(msg):
+
+    """Report the progress of the current task (no-op outside of a task).
+
+    This is also where a running task stops when it has been cancelled.
+    """
+
+    reporter = getattr(_local,'reporter',None)
+    if reporter is not None:
+        reporter(msg)
+
+def traced(name, state, func, *args):
+
+    """Run func in an action, used to carry the trace settings to the worker processes."""
+
+    _state.update(state)
+    with action(name):
+        return func(*args)
+
+def report_error(context, inst):
+
+    """Print an error with its traceback instead of only its message."""
+
+    print('-- %s failed : %s : %s' %(context,type(inst).__name__,inst))
+    print(''.join(traceback.format_exception(type(inst),inst,inst.__traceback__)))
@@ -0,0 +1,122 @@
+import os
+import h5py
+from PyQt5 import QtCore
+
+# polling interval in seconds
+FOLLOW_INTERVAL = float(os.environ.get('DEEPXPLORER_FOLLOW_INTERVAL',10))
+
+def _open(fname):
+
+    # SWMR only works if the training writes the file in SWMR mode
+    try:
+        return h5py.File(fname,'r',libver='latest',swmr=True)
+    except (OSError,ValueError):
+        return h5py.File(fname,'r')
+
+def _new_losses(h5file, nlosses):
+
+    new = {}
+    for name in h5file.keys():
+        grp = h5file[name]
+        if not isinstance(grp,h5py.Group) or grp.attrs.get('type',None) != 'losses':
+            continue
+        for split in grp.keys():
+            dset = grp[split]
+            nold, n = nlosses.get(split,0), dset.shape[0]
+            if n > nold:
+                new[split] = dset[nold:n]
+                nlosses[split] = n
+    return new
+
+def _losses_path(h5file):
+    for name in h5file.keys():
+        if h5file[name].attrs.get('type',None) == 'losses':
+            return h5file[name].name
+    return None
+
+def _new_epochs(h5file, epochs, metric):
+
+    from metrics import epoch_scores
+
+    new = []
+    for name in sorted(h5file.keys()):
+        if name in epochs:
+            continue
+        grp = h5file[name]
+        if isinstance(grp,h5py.Group) and grp.attrs.get('type',None) == 'epoch':
+            new.append(grp.name)
+            epochs.add(name)
+
+    losses_path = _losses_path(h5file)
+    return [tuple([p.split('/')[-1]] + epoch_scores(h5file,p,metric,losses_path=losses_path)) for p in new]
+
+def poll_file(fname, nlosses, epochs, metric='hitrate'):
+
+    """Read the losses and score the epochs added since the last poll.
+
+    nlosses {split:number of values} and epochs (names) are what was read
+    before. Return the new data {'losses','epochs'} and the updated nlosses
+    and epochs, or None if the file could not be read. This runs in a worker
+    process, where the file is not already opened by the browser, so it can
+    be opened in SWMR mode.
+    """
+
+    nlosses, epochs = dict(nlosses), set(epochs)
+    try:
+        with _open(fname) as h5file:
+            data = {'losses':_new_losses(h5file,nlosses),'epochs':_new_epochs(h5file,epochs,metric)}
+    except (OSError,KeyError) as inst:
+        # e.g. the file is locked by the training, tried again at the next poll
+        print('-- Follow %s : %s' %(fname,inst))
+        return None
+    return data, nlosses, epochs
+
+class LiveTail(QtCore.QObject):
+
+    def __init__(self, fname, callback, manager, interval=FOLLOW_INTERVAL, metric='hitrate'):
+        """Follow a training file while it is written.
+
+        Each poll is submitted to a worker process of the task manager
+        (TaskManager) that opens the file, reads only the new losses and scores the
+        new epochs. The browser holds the file open without SWMR and HDF5
+        refuses a second SWMR open of the same file in one process, so the
+        file is never read for the follow mode in the GUI process. The callback
+        receives {'losses':{split:new values}, 'epochs':[(name,train,valid,test)]}
+        each time new data is found.
+        """
+
+        super().__init__()
+        self.fname = fname
+        self.callback = callback
+        self.manager = manager
+        self.metric = metric
+
+        self.nlosses = {}
+        self.epochs = set()
+        self.tid = None
+        self.stopped = False
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(int(1000*interval))
+
+    def poll(self):
+
+        # one poll at a time, a slow scoring delays the next one
+        if self.stopped or self.tid in self.manager.tasks:
+            return
+        self.tid = self.manager.submit('Follow ' + os.path.basename(self.fname),poll_file,self.fname,self.nlosses,
+                                       sorted(self.epochs),self.metric,callback=self._received,process=True)
+
+    def _received(self, result):
+
+        # called in the GUI thread
+        if self.stopped or result is None:
+            return
+        data, self.nlosses, self.epochs = result
+        if len(data['losses']) > 0 or len(data['epochs']) > 0:
+            self.callback(data)
+
+    def stop(self):
+        self.stopped = True
+        self.timer.stop()
@@ -1,10 +1,144 @@
 import viztools
+import volformats
 from PyQt5 import QtWidgets
 from h5xplorer.menu_tools import *
-from deeprank.tools import sparse
-from pdb2sql import pdb2sql
-from deeprank.learn import rankingMetrics
+from worker import TaskManager
+from h5index import get_index
+from sqlpool import get_sql_pool
+from featstats import get_feature_index
+from export_cache import ExportCache
+import instrument
+from metrics import get_metric_engine, rank_epochs, regression_stats, avprec, bootstrap
+from handoff import as_array
+from columnar import export_epochs, load_columns
+from livetail import LiveTail
 import numpy as np
+import os
+
+# above this number of points the scatter plot shows the density of the points
+# either as a 2D histogram per split ('hist') or with a stratified subsample ('sample')
+SCATTER_MAX_POINTS = int(os.environ.get('DEEPXPLORER_SCATTER_MAX_POINTS',50000))
+SCATTER_DENSITY = os.environ.get('DEEPXPLORER_SCATTER_DENSITY','hist')
+SCATTER_BINS = 200
+
+# the heavy actions run in the background
+_task_manager = None
+
+def get_task_manager():
+    global _task_manager
+    if _task_manager is None:
+        _task_manager = TaskManager()
+    return _task_manager
+
+def _run_task(treeview,name,func,*args,cmd=None,process=False):
+
+    """Run func in the background and send its results to the console"""
+
+    def _emit(data_dict):
+        with instrument.action('Console ' + name):
+            treeview.emitDict.emit(data_dict)
+            if cmd is not None:
+                treeview.emitDict.emit({'exec_cmd':cmd})
+
+    return get_task_manager().submit(name,func,*args,callback=_emit,process=process)
+
+def _export_columns(data_file,treeview):
+
+    # all the epochs in memory mapped columns, only written again when the file changed
+    def _export():
+        return {'_columns':load_columns(export_epochs(data_file))}
+
+    cmd  = "print('%d rows, columns %s' %(len(_columns['epoch']),', '.join(k for k in _columns if k != 'index')))\n"
+    _run_task(treeview,'Export Epochs',_export,cmd=cmd)
+
+# criteria of the Best Epoch actions
+_best_epoch_metrics = {'Best Epoch (Hit Rate)':'hitrate','Best Epoch (Av. Prec.)':'avprec','Best Epoch (Loss)':'loss'}
+
+def _best_epoch(data_file,treeview,metric):
+
+    # each epoch is scored with the losses of its own run (multi-run views)
+    index = get_index(data_file)
+    epoch_paths = index.find(type='epoch')
+    losses_paths = index.find(type='losses')
+
+    def _rank():
+        return {'_ranking':rank_epochs(data_file,epoch_paths,metric=metric,losses_paths=losses_paths)}
+
+    cmd  = "_w = max([16] + [len(r[0]) for r in _ranking])\n"
+    cmd += "print('%-*s %12s %12s %12s' %(_w,'epoch','train','valid','test'))\n"
+    cmd += "for r in _ranking:\n"
+    cmd += "    print('%-*s %12.6f %12.6f %12.6f' %((_w,)+tuple(r)))\n"
+    _run_task(treeview,'Best Epoch (%s)' %metric,_rank,cmd=cmd)
+
+# files followed while the training is running
+_followers = {}
+
+def _follow(data_file,treeview):
+
+    fname = data_file.filename
+
+    # append the new values to the ones already in the console and replot
+    def _update(data):
+        treeview.emitDict.emit({'_new_losses':data['losses'],'_new_epochs':data['epochs']})
+        cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\nimport numpy as np\n"
+        cmd += "_losses = globals().get('_losses',{})\n"
+        cmd += "_epoch_scores = globals().get('_epoch_scores',[])\n"
+        cmd += "for k,v in _new_losses.items():\n"
+        cmd += "    _losses[k] = np.concatenate([_losses.get(k,np.zeros(0)),v])\n"
+        cmd += "for e in _new_epochs:\n"
+        cmd += "    _epoch_scores.append(e)\n"
+        cmd += "    print('%-16s hit rate train %8.4f valid %8.4f test %8.4f' %tuple(e))\n"
+        cmd += "if len(_new_losses) > 0:\n"
+        cmd += "    fig,ax = plt.subplots()\n"
+        cmd += "    for k,c in zip(['train','valid','test'],['red','blue','green']):\n"
+        cmd += "        if k in _losses:\n"
+        cmd += "            plt.plot(_losses[k],c=c,label=k)\n"
+        cmd += "    legen = ax.legend(loc='upper right')\n"
+        cmd += "    ax.set_xlabel('Epoch')\n"
+        cmd += "    ax.set_ylabel('Losses')\n"
+        cmd += "    plt.show()\n"
+        treeview.emitDict.emit({'exec_cmd':cmd})
+
+    # start from an empty history in the console
+    treeview.emitDict.emit({'_losses':{},'_epoch_scores':[]})
+    _followers[fname] = LiveTail(fname,_update,get_task_manager())
+    _followers[fname].poll()
+
+def _unfollow(data_file):
+    tail = _followers.pop(data_file.filename,None)
+    if tail is not None:
+        tail.stop()
+
+def _follow_operations(data_file):
+    if data_file.filename in _followers:
+        return ['Stop Following']
+    return ['Follow Training']
+
+def _follow_actions(data_file,treeview,action,actions):
+    if 'Follow Training' in actions and action == actions['Follow Training']:
+        _follow(data_file,treeview)
+    if 'Stop Following' in actions and action == actions['Stop Following']:
+        _unfollow(data_file)
+
+def _get_actions(treeview,position,list_operations):
+    # the time the menu stays open is not counted in the traced action
+    with instrument.excluded('menu popup'):
+        return get_actions(treeview,position,list_operations)
+
+def _task_operations():
+    operations = ['Stop Tracing' if instrument.enabled() else 'Start Tracing']
+    if get_task_manager().pending() > 0:
+        operations.append('Cancel Tasks')
+    return operations
+
+def _task_actions(action,actions):
+    if 'Cancel Tasks' in actions and action == actions['Cancel Tasks']:
+        get_task_manager().cancel_all()
+    if 'Start Tracing' in actions and action == actions['Start Tracing']:
+        instrument.set_enabled(True)
+        print('-- Tracing the actions in %s' %instrument.settings()['file'])
+    if 'Stop Tracing' in actions and action == actions['Stop Tracing']:
+        instrument.set_enabled(False)
 
 def context_menu(self, treeview, position):
 
@@ -13,95 +147,246 @@ def context_menu(self, treeview, position):
     # make sure tha there is only one item selected
     all_item = get_current_item(self,treeview,single=False)
 
+    # group attributes are read once and cached
+    index = get_index(self.root_item.data_file)
+
     if len(all_item) == 1:
 
         item = all_item[0]
 
         try:
 
-            _type = self.root_item.data_file[item.name].attrs['type']
+            _type = index.get(item.name,'type')
 
-            if _type == 'molecule':
-                molgrp = self.root_item.data_file[item.name]
-                _context_mol(item,treeview,position,molgrp)
+            # the time spent in the menus is recorded with the action
+            with instrument.action('Menu %s' %_type,item=item.name,file=item.data_file.filename):
 
-            if _type == 'sparse_matrix':
-                _context_sparse(item,treeview,position)
+                if _type == 'molecule':
+                    molgrp = self.root_item.data_file[item.name]
+                    _context_mol(item,treeview,position,molgrp)
 
-            if _type == 'epoch':
-                _task = self.root_item.data_file[item.name].attrs['task']
-                _context_one_epoch(item,treeview,position,_task)
+                if _type == 'sparse_matrix':
+                    _context_sparse(item,treeview,position)
 
-            if _type == 'losses':
-                _context_losses(item,treeview,position)
+                if _type == 'epoch':
+                    _task = index.get(item.name,'task')
+                    _context_one_epoch(item,treeview,position,_task)
+
+                if _type == 'losses':
+                    _context_losses(item,treeview,position)
 
         except Exception as inst:
-            print(type(inst))
-            print(inst)
+            instrument.report_error('Action on %s' %item.name,inst)
             return
 
     else :
 
-        _type = np.array([self.root_item.data_file[item.name].attrs['type'] for item in all_item])
-        epoch_item = [item for item in all_item if self.root_item.data_file[item.name].attrs['type'] == 'epoch' ]
-        haddock_item = [item for item in all_item if self.root_item.data_file[item.name].attrs['type'] == 'haddock' ]
+        _type = [index.get(item.name,'type') for item in all_item]
+        epoch_item = [item for item,t in zip(all_item,_type) if t == 'epoch' ]
+        haddock_item = [item for item,t in zip(all_item,_type) if t == 'haddock' ]
+        mol_item = [item for item,t in zip(all_item,_type) if t == 'molecule' ]
 
-        _context_multiple_epoch_multilevel(epoch_item,treeview,position,haddock_item)
+        try:
+            if len(mol_item) > 0 and len(epoch_item) == 0:
+                with instrument.action('Menu multiple molecules',nitems=len(mol_item),file=self.root_item.data_file.filename):
+                    _context_multiple_mol(mol_item,treeview,position)
+            else:
+                with instrument.action('Menu multiple epochs',nitems=len(all_item),file=self.root_item.data_file.filename):
+                    _context_multiple_epoch_multilevel(epoch_item,treeview,position,haddock_item)
+        except Exception as inst:
+            instrument.report_error('Action on %d items' %len(all_item),inst)
 
 
 def _context_mol(item,treeview,position,molgrp):
 
+    # the large grids are first shown at a coarser level of detail
+    # the full resolution is only exported on demand
+    lod = viztools.preview_level(molgrp)
+
     menu = QtWidgets.QMenu()
     actions = {}
-    list_operations = ['Load in PyMol','Load in VMD','PDB2SQL']
+    list_operations = ['Load in PyMol','Load in VMD']
+    if lod > 1:
+        list_operations += ['Load Full Resolution in PyMol','Load Full Resolution in VMD']
+    list_operations += ['PDB2SQL'] + _task_operations()
 
     for operation in list_operations:
         actions[operation] = menu.addAction(operation)
-    action = menu.exec_(treeview.viewport().mapToGlobal(position))
+    with instrument.excluded('menu popup'):
+        action = menu.exec_(treeview.viewport().mapToGlobal(position))
 
     _,cplx_name, mol_name = item.name.split('/')
     mol_name = mol_name.replace('-','_')
 
+    # the grid mapping and cube export run in a separate process
+    # that opens the file itself and then the data are sent to the viewer
+    # in a thread as starting the viewer session can take a while
+    def _launch(launcher,lod):
+        def _callback(result):
+            mol_path, export_path, error = result
+            if error is not None:
+                print('-- Export of %s failed (%s)' %(mol_path,error))
+            else:
+                get_task_manager().submit('Load ' + mol_name,_with_levels(molgrp.file,launcher,lod),[mol_path],[export_path])
+        return _callback
+
+    fmt_pymol, fmt_vmd = _viewer_formats()
+
+    def _export(fmt,launcher,lod):
+        args = (molgrp.file.filename,molgrp.name,{'fmt':fmt,'lod':lod})
+        name = mol_name if lod == 1 else '%s (preview 1/%d)' %(mol_name,lod)
+        get_task_manager().submit('Export ' + name,viztools._export_molecule,args,
+                                  callback=_launch(launcher,lod),process=True)
+
+    launch_vmd = lambda p: viztools.launchVMD(p[0],fmt_vmd)
+    launch_pymol = lambda p: viztools.launchPyMol(p[0],fmt_pymol)
+
     if action == actions['Load in VMD']:
-        viztools.create3Ddata(mol_name, molgrp)
-        viztools.launchVMD(mol_name)
+        _export(fmt_vmd,launch_vmd,lod)
 
     if action == actions['Load in PyMol']:
-        viztools.create3Ddata(mol_name,molgrp)
-        viztools.launchPyMol(mol_name)
+        _export(fmt_pymol,launch_pymol,lod)
+
+    if lod > 1 and action == actions['Load Full Resolution in VMD']:
+        _export(fmt_vmd,launch_vmd,1)
+
+    if lod > 1 and action == actions['Load Full Resolution in PyMol']:
+        _export(fmt_pymol,launch_pymol,1)
 
+    # the sqlite database of pdb2sql can only be used in the thread that created it
+    # the database is pinned as it is handed to the console
     if action == actions['PDB2SQL']:
-        db = pdb2sql(molgrp['complex'].value)
+        db = get_sql_pool().get(molgrp,pin=True)
         treeview.emitDict.emit({'sql_' + item.basename: db})
 
+    _task_actions(action,actions)
+
+def _feature_index(data_file):
+    # the previews need the statistics of their level of detail too
+    return get_feature_index(data_file,viztools.LOD_LEVELS,viztools.LOD_MODE)
+
+def _with_levels(data_file,launcher,lod):
+
+    # the isosurface levels are taken from the statistics of the features
+    # over the whole file if they were already computed (Dataset Histogram)
+    # the file is not scanned only to load molecules
+    def _load(mol_paths,export_paths):
+        index = _feature_index(data_file)
+        for mol_path,p in zip(mol_paths,export_paths):
+            viztools.write_isosurface_levels(p,data_file[mol_path],index,lod)
+        launcher(export_paths)
+    return _load
+
+def _viewer_formats():
+    # VMD can't read the compressed formats
+    fmt_pymol = viztools.VOLUME_FORMAT
+    fmt_vmd = fmt_pymol if 'vmd' in volformats.FORMATS[fmt_pymol]['viewers'] else 'ccp4'
+    return fmt_pymol, fmt_vmd
+
+def _context_multiple_mol(mol_item,treeview,position):
+
+    # the same level of detail for all the molecules so that they can be compared
+    data_file = mol_item[0].data_file
+    mol_paths = [item.name for item in mol_item]
+    lod = max(viztools.preview_level(data_file[p]) for p in mol_paths)
+
+    list_operations = ['Load All in PyMol','Load All in VMD']
+    if lod > 1:
+        list_operations += ['Load All Full Resolution in PyMol','Load All Full Resolution in VMD']
+    list_operations += _task_operations()
+    action,actions = _get_actions(treeview,position,list_operations)
+
+    fmt_pymol, fmt_vmd = _viewer_formats()
+
+    # the molecules are exported in parallel by the workers of the process pool
+    # (one thread per molecule) and loaded together once they are all exported
+    def _export_all(viewer,fmt,lod):
+
+        export_paths, failed, finished = {}, [], []
+        def _callback(result):
+            mol_path, export_path, error = result
+            if error is not None:
+                print('-- Export of %s failed (%s)' %(mol_path,error))
+            else:
+                export_paths[mol_path] = export_path
+
+        # the done hook is also called for the failed and cancelled exports
+        def _done(mol_path):
+            def _hook(status):
+                if status[1] != 'done' or mol_path not in export_paths:
+                    failed.append(mol_path)
+                finished.append(mol_path)
+                if len(finished) == len(mol_paths):
+                    _load_all()
+            return _hook
+
+        def _load_all():
+            if len(failed) > 0:
+                print('-- %d of %d molecules not exported : %s' %(len(failed),len(mol_paths),', '.join(failed)))
+            done = [p for p in mol_paths if p in export_paths]
+            paths = [export_paths[p] for p in done]
+            load = _with_levels(data_file,lambda p: viztools.launch_molecules(p,viewer,fmt),lod)
+            get_task_manager().submit('Load %d molecules' %len(paths),_evict_load,load,done,paths)
+
+        # the cache is evicted once, keeping the molecules of this export
+        def _evict_load(load,done,paths):
+            ExportCache().evict(keep=paths)
+            if len(paths) > 0:
+                load(done,paths)
+
+        for path in mol_paths:
+            args = (data_file.filename,path,{'fmt':fmt,'lod':lod,'nthreads':1,'evict':False})
+            get_task_manager().submit('Export ' + path,viztools._export_molecule,args,
+                                      callback=_callback,done=_done(path),process=True)
+
+    if action == actions['Load All in PyMol']:
+        _export_all('pymol',fmt_pymol,lod)
+
+    if action == actions['Load All in VMD']:
+        _export_all('vmd',fmt_vmd,lod)
+
+    if lod > 1 and action == actions['Load All Full Resolution in PyMol']:
+        _export_all('pymol',fmt_pymol,1)
+
+    if lod > 1 and action == actions['Load All Full Resolution in VMD']:
+        _export_all('vmd',fmt_vmd,1)
+
+    _task_actions(action,actions)
+
 def _context_sparse(item,treeview,position):
 
     menu = QtWidgets.QMenu()
-    list_operations = ['Load Matrix','Plot Histogram']
-    action,actions = get_actions(treeview,position,list_operations)
+    list_operations = ['Load Matrix','Plot Histogram','Dataset Histogram'] + _task_operations()
+    action,actions = _get_actions(treeview,position,list_operations)
 
     name = item.basename + '_' + item.name.split('/')[2]
 
     if action == actions['Load Matrix']:
 
-        subgrp = item.data_file[item.name]
-        data_dict = {}
-        if not subgrp.attrs['sparse']:
-            data_dict[item.name] =  subgrp['value'].value
-        else:
-            molgrp = item.data_file[item.parent.parent.parent.name]
-            grid = {}
-            lx = len(molgrp['grid_points/x'].value)
-            ly = len(molgrp['grid_points/y'].value)
-            lz = len(molgrp['grid_points/z'].value)
-            shape = (lx,ly,lz)
-            spg = sparse.FLANgrid(sparse=True,index=subgrp['index'].value,value=subgrp['value'].value,shape=shape)
-            data_dict[name] =  spg.to_dense()
-        treeview.emitDict.emit(data_dict)
+        def _load_matrix():
+            from deeprank.tools import sparse
+            subgrp = item.data_file[item.name]
+            data_dict = {}
+            if not get_index(item.data_file).get(item.name,'sparse'):
+                with instrument.phase('hdf5 read'):
+                    data_dict[item.name] =  as_array(subgrp['value'])
+            else:
+                with instrument.phase('hdf5 read'):
+                    molgrp = item.data_file[item.parent.parent.parent.name]
+                    lx = molgrp['grid_points/x'].shape[0]
+                    ly = molgrp['grid_points/y'].shape[0]
+                    lz = molgrp['grid_points/z'].shape[0]
+                    shape = (lx,ly,lz)
+                    spg = sparse.FLANgrid(sparse=True,index=subgrp['index'][()],value=subgrp['value'][()],shape=shape)
+                with instrument.phase('densify'):
+                    data_dict[name] =  spg.to_dense()
+            return data_dict
+
+        _run_task(treeview,'Load Matrix ' + name,_load_matrix)
 
     if action == actions['Plot Histogram']:
 
-        value = item.data_file[item.name]['value'].value
+        value = as_array(item.data_file[item.name]['value'])
         data_dict = {'value':value}
         treeview.emitDict.emit(data_dict)
 
@@ -109,6 +394,80 @@ def _context_sparse(item,treeview,position):
         data_dict = {'exec_cmd':cmd}
         treeview.emitDict.emit(data_dict)
 
+    # histogram of the feature over all the molecules of the file
+    # the first request scans the file, the next ones are read from the index
+    if action == actions['Dataset Histogram']:
+
+        feat_name = '/'.join(item.name.split('/')[-2:])
+
+        def _dataset_histogram():
+            stats = _feature_index(item.data_file).get(feat_name)
+            return {'feature_stats':stats}
+
+        cmd = "%matplotlib inline\nimport numpy as np\nimport matplotlib.pyplot as plt\n"
+        cmd += "print({k:v for k,v in feature_stats.items() if k not in ['counts','edges']})\n"
+        cmd += "edges = feature_stats['edges']\n"
+        cmd += "plt.bar(edges[:-1],feature_stats['counts'],width=np.diff(edges),align='edge')\n"
+        cmd += "plt.yscale('log')\nplt.title('%s')\nplt.show()\n" %feat_name
+        _run_task(treeview,'Dataset Histogram ' + feat_name,_dataset_histogram,cmd=cmd)
+
+    _task_actions(action,actions)
+
+def _epoch_hitrate(item):
+
+    engine = get_metric_engine(item.data_file)
+    values = []
+    for split in ['train','valid','test']:
+        hitrate = engine.compute([item.name],split,'hitrate')[0]
+        if hitrate is not None:
+            values.append(hitrate)
+
+    return {'_values':values}
+
+def _scatter_splits(item):
+    return [s for s in ['train','valid','test'] if s in item.data_file[item.name]]
+
+def _scatter_mode(item):
+    npts = sum(item.data_file[item.name+'/'+s+'/targets'].shape[0] for s in _scatter_splits(item))
+    if npts > SCATTER_MAX_POINTS:
+        return SCATTER_DENSITY
+    return 'scatter'
+
+def _epoch_scatter(item,mode='scatter'):
+
+    # (targets, outputs) of each split
+    splits = _scatter_splits(item)
+    values, stats = [], {}
+    for split in splits:
+        tar = as_array(item.data_file[item.name+'/'+split+'/targets'])
+        out = as_array(item.data_file[item.name+'/'+split+'/outputs'])
+        values += [tar,out]
+        stats[split] = regression_stats(tar,out)
+
+    vmin = min(np.min(v) for v in values)
+    vmax = max(np.max(v) for v in values)
+    delta = vmax-vmin
+    lim = [vmin - 0.1*delta, vmax + 0.1*delta]
+
+    # keep the same fraction of each split evenly spread over the sorted targets
+    if mode == 'sample':
+        npts = sum(len(v) for v in values[::2])
+        for i in range(0,len(values),2):
+            n = len(values[i])
+            nkeep = max(1,int(np.ceil(SCATTER_MAX_POINTS*n/npts)))
+            index = np.argsort(values[i],kind='stable')[np.linspace(0,n-1,min(n,nkeep)).astype(int)]
+            values[i],values[i+1] = values[i][index],values[i+1][index]
+
+    # one 2D histogram per split
+    elif mode == 'hist':
+        edges = np.linspace(lim[0],lim[1],SCATTER_BINS+1)
+        values = [np.histogram2d(values[i],values[i+1],bins=[edges,edges])[0] for i in range(0,len(values),2)]
+        return {'_values':values,'_edges':edges,'_splits':splits,'_stats':stats}
+
+    values.append([lim[1]])
+    values.append([lim[0]])
+    return {'_values':values,'_splits':splits,'_stats':stats}
+
 def _context_one_epoch(item,treeview,position,task):
 
     menu = QtWidgets.QMenu()
@@ -116,69 +475,39 @@ def _context_one_epoch(item,treeview,position,task):
 
     if task == 'reg':
 
-        list_operations = ['Scatter Plot','Hit Rate']
-        action,actions = get_actions(treeview,position,list_operations)
+        list_operations = ['Scatter Plot','Hit Rate'] + list(_best_epoch_metrics) + ['Export All Epochs'] + _follow_operations(item.data_file) + _task_operations()
+        action,actions = _get_actions(treeview,position,list_operations)
 
         if action == actions['Scatter Plot']:
 
-            values = []
-            train_out = item.data_file[item.name+'/train/outputs'].value
-            train_tar = item.data_file[item.name+'/train/targets'].value
-            values.append([x for x in train_out])
-            values.append([x for x in train_tar])
-
-
-            valid_out = item.data_file[item.name+'/valid/outputs'].value
-            valid_tar = item.data_file[item.name+'/valid/targets'].value
-            values.append([x for x in valid_tar])
-            values.append([x for x in valid_out])
+            mode = _scatter_mode(item)
+            colors = "{'train':'red','valid':'blue','test':'green'}"
 
-
-            if 'test' in item.data_file[item.name]:
-                test_out = item.data_file[item.name+'/test/outputs'].value
-                test_tar = item.data_file[item.name+'/test/targets'].value
-                values.append([x for x in test_tar])
-                values.append([x for x in test_out])
-
-            vmin = np.array([x for a in values for x in a]).min()
-            vmax = np.array([x for a in values for x in a]).max()
-            delta = vmax-vmin
-            values.append([vmax + 0.1*delta])
-            values.append([vmin - 0.1*delta])
-
-            data_dict = {'_values':values}
-            treeview.emitDict.emit(data_dict)
-
-            data_dict = {}
             cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\n"
-            cmd += "fig,ax = plt.subplots()\n"
-            cmd += "ax.scatter(_values[0],_values[1],c='red',label='train')\n"
-            cmd += "ax.scatter(_values[2],_values[3],c='blue',label='valid')\n"
-            if 'test' in item.data_file[item.name]:
-                cmd += "ax.scatter(_values[4],_values[5],c='green',label='test')\n"
-            cmd += "legen = ax.legend(loc='upper left')\n"
-            cmd += "ax.set_xlabel('Targets')\n"
-            cmd += "ax.set_ylabel('Predictions')\n"
-            cmd += "ax.plot([_values[-2],_values[-1]],[_values[-2],_values[-1]])\n"
+            if mode == 'hist':
+                cmd += "from matplotlib.colors import LogNorm\n"
+                cmd += "fig,axes = plt.subplots(1,len(_splits),figsize=(5*len(_splits),4),squeeze=False)\n"
+                cmd += "for ax,h,s in zip(axes[0],_values,_splits):\n"
+                cmd += "    ax.pcolormesh(_edges,_edges,h.T,norm=LogNorm())\n"
+                cmd += "    ax.plot(_edges[[0,-1]],_edges[[0,-1]],c='black')\n"
+                cmd += "    ax.set_title(s)\n"
+                cmd += "    ax.set_xlabel('Targets')\n"
+                cmd += "    ax.set_ylabel('Predictions')\n"
+            else:
+                cmd += "fig,ax = plt.subplots()\n"
+                cmd += "for i,s in enumerate(_splits):\n"
+                cmd += "    ax.scatter(_values[2*i],_values[2*i+1],c=%s[s],label=s)\n" %colors
+                cmd += "legen = ax.legend(loc='upper left')\n"
+                cmd += "ax.set_xlabel('Targets')\n"
+                cmd += "ax.set_ylabel('Predictions')\n"
+                cmd += "ax.plot([_values[-2],_values[-1]],[_values[-2],_values[-1]])\n"
             cmd += "plt.show()\n"
-            data_dict['exec_cmd'] = cmd
-            treeview.emitDict.emit(data_dict)
+            cmd += "for s in _splits:\n"
+            cmd += "    print('%-6s n = %8d  pearson = %7.4f  rmse = %10.4e  mae = %10.4e' %(s,_stats[s]['n'],_stats[s]['pearson'],_stats[s]['rmse'],_stats[s]['mae']))\n"
+            _run_task(treeview,'Scatter Plot ' + item.basename,_epoch_scatter,item,mode,cmd=cmd)
 
         if action == actions['Hit Rate']:
 
-            values = []
-            train_hit = item.data_file[item.name+'/train/hit'].value
-            valid_hit = item.data_file[item.name+'/valid/hit'].value
-            values.append(rankingMetrics.hitrate(train_hit))
-            values.append(rankingMetrics.hitrate(valid_hit))
-            if 'test' in item.data_file[item.name]:
-                test_hit = item.data_file[item.name+'/test/hit'].value
-                values.append(rankingMetrics.hitrate(test_hit))
-
-            data_dict = {'_values':values}
-            treeview.emitDict.emit(data_dict)
-
-            data_dict = {}
             cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\n"
             cmd += "plt.plot(_values[0],c='red',label='train')\n"
             cmd += "plt.plot(_values[1],c='blue',label='valid')\n"
@@ -188,29 +517,15 @@ def _context_one_epoch(item,treeview,position,task):
             cmd += "ax.set_xlabel('Top M')\n"
             cmd += "ax.set_ylabel('Hit rate')\n"
             cmd += "plt.show()\n"
-            data_dict['exec_cmd'] = cmd
-            treeview.emitDict.emit(data_dict)
+            _run_task(treeview,'Hit Rate ' + item.basename,_epoch_hitrate,item,cmd=cmd)
 
 
     elif task == 'class':
-        list_operations = ['Hit Rate']
-        action,actions = get_actions(treeview,position,list_operations)
+        list_operations = ['Hit Rate'] + list(_best_epoch_metrics) + ['Export All Epochs'] + _follow_operations(item.data_file) + _task_operations()
+        action,actions = _get_actions(treeview,position,list_operations)
 
         if action == actions['Hit Rate']:
 
-            values = []
-            train_hit = item.data_file[item.name+'/train/hit'].value
-            valid_hit = item.data_file[item.name+'/valid/hit'].value
-            values.append(rankingMetrics.hitrate(train_hit))
-            values.append(rankingMetrics.hitrate(valid_hit))
-            if 'test' in item.data_file[item.name]:
-                test_hit = item.data_file[item.name+'/test/hit'].value
-                values.append(rankingMetrics.hitrate(test_hit))
-
-            data_dict = {'_values':values}
-            treeview.emitDict.emit(data_dict)
-
-            data_dict = {}
             cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\n"
             cmd += "fig,ax = plt.subplots()\n"
             cmd += "plt.plot(_values[0],c='red',label='train')\n"
@@ -221,46 +536,53 @@ def _context_one_epoch(item,treeview,position,task):
             cmd += "ax.set_xlabel('Top M')\n"
             cmd += "ax.set_ylabel('Hit rate')\n"
             cmd += "plt.show()\n"
-            data_dict['exec_cmd'] = cmd
-            treeview.emitDict.emit(data_dict)
+            _run_task(treeview,'Hit Rate ' + item.basename,_epoch_hitrate,item,cmd=cmd)
+
+    else:
+        return
+
+    for op,metric in _best_epoch_metrics.items():
+        if action == actions[op]:
+            _best_epoch(item.data_file,treeview,metric)
+
+    if action == actions['Export All Epochs']:
+        _export_columns(item.data_file,treeview)
+
+    _follow_actions(item.data_file,treeview,action,actions)
+
+    _task_actions(action,actions)
 
 
 def _context_multiple_epoch(epoch_items,treeview,position,haddock_item=None):
 
     list_operations = ['Hit Rate (Train)','Hit Rate (Valid)', 'Hit Rate (Test)']
-    action,actions = get_actions(treeview,position,list_operations)
+    action,actions = _get_actions(treeview,position,list_operations)
 
-    values = []
-    names = []
-    if action == actions['Hit Rate (Train)']:
-        for item in epoch_items:
-            hit = item.data_file[item.name+'/train/hit'].value
-            names.append(item.name.split('/')[-1])
-            values.append(rankingMetrics.hitrate(hit))
-
-    if action == actions['Hit Rate (Valid)']:
-        for item in epoch_items:
-            hit = item.data_file[item.name+'/valid/hit'].value
-            names.append(item.name.split('/')[-1])
-            values.append(rankingMetrics.hitrate(hit))
-
-    if action == actions['Hit Rate (Test)']:
-        for item in epoch_items:
-            if 'test' in item.data_file[item.name]:
-                hit = item.data_file[item.name+'/test/hit'].value
-                names.append(item.name.split('/')[-1])
-                values.append(rankingMetrics.hitrate(hit))
+    def _multiple_hitrate():
 
-    if haddock_item is not None:
-        for item in haddock_item:
-            hit = item.data_file[item.name+'/hitrate'].value
-            names.append('haddock')
-            values.append(hit)
+        split = None
+        for subop in ['Train','Valid','Test']:
+            if action == actions['Hit Rate (%s)' %subop]:
+                split = subop.lower()
 
-    data_dict = {'_values':values,'_names':names}
-    treeview.emitDict.emit(data_dict)
+        values = []
+        names = []
+        if split is not None:
+            epoch_paths = [item.name for item in epoch_items]
+            hitrates = get_metric_engine(epoch_items[0].data_file).compute(epoch_paths,split,'hitrate')
+            for path,hitrate in zip(epoch_paths,hitrates):
+                if hitrate is not None:
+                    names.append(path.split('/')[-1])
+                    values.append(hitrate)
+
+        if haddock_item is not None:
+            for item in haddock_item:
+                hit = item.data_file[item.name+'/hitrate'][()]
+                names.append('haddock')
+                values.append(hit)
+
+        return {'_values':values,'_names':names}
 
-    data_dict = {}
     cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\n"
     cmd += "fig,ax = plt.subplots()\n"
     cmd += "for v,n in zip(_values,_names):"
@@ -269,66 +591,113 @@ def _context_multiple_epoch(epoch_items,treeview,position,haddock_item=None):
     cmd += "ax.set_xlabel('Top M')\n"
     cmd += "ax.set_ylabel('Hitrate')\n"
     cmd += "plt.show()\n"
-    data_dict['exec_cmd'] = cmd
-    treeview.emitDict.emit(data_dict)
+    _run_task(treeview,'Hit Rate (%d epochs)' %len(epoch_items),_multiple_hitrate,cmd=cmd)
+
+def _haddock_hits(hitrate):
+    # the hits are where the hit rate increases
+    return np.diff(np.concatenate([[0.],np.nan_to_num(hitrate)])) > 0
+
+def _haddock_metric(item,metric,ci=False):
+
+    hitrate = item.data_file[item.name+'/hitrate'][()]
+    if ci:
+        return bootstrap(_haddock_hits(hitrate),metric)[0]
+    if metric == 'hitrate':
+        return hitrate
+    return avprec(_haddock_hits(hitrate))[0]
 
 def _context_multiple_epoch_multilevel(epoch_items,treeview,position,haddock_item=None):
 
-    func_operations = {'Hit Rate':rankingMetrics.hitrate, 'Av. Prec.': rankingMetrics.avprec }
-    list_operations = ['Hit Rate','Av. Prec.']
-    list_subop = [['Train','Valid','Test'],['Train','Valid','Test']]
+    func_operations = {'Hit Rate':'hitrate', 'Av. Prec.':'avprec', 'Hit Rate (95% CI)':'hitrate', 'Av. Prec. (95% CI)':'avprec'}
+    list_operations = ['Hit Rate','Av. Prec.','Hit Rate (95% CI)','Av. Prec. (95% CI)']
+    list_subop = [['Train','Valid','Test']]*len(list_operations)
     action,actions = get_multilevel_actions(treeview,position,list_operations,list_subop)
 
+    plot_type = None
     for iop,op in enumerate(list_operations):
         for subop in list_subop[iop]:
             if action == actions[(op,subop)]:
                 plot_type,data_type = op,subop.lower()
+    if plot_type is None:
+        return
+
+    # all the epochs are computed at once and the results are cached
+    # the epochs of a view of several files are named /<file>/<epoch>
+    ci = plot_type.endswith('CI)')
+    def _multiple_metric():
+        names, values, bands = [], [], []
+        metric = func_operations[plot_type]
+        if len(epoch_items) > 0:
+            epoch_paths = [item.name for item in epoch_items]
+            engine = get_metric_engine(epoch_items[0].data_file)
+            curves = engine.compute(epoch_paths,data_type,metric)
+            cis = engine.compute_ci(epoch_paths,data_type,metric) if ci else [None]*len(curves)
+            for path,v,b in zip(epoch_paths,curves,cis):
+                if v is not None:
+                    names.append(path.strip('/'))
+                    values.append(v)
+                    bands.append(b)
+
+        # the baselines only store their hit rate
+        for item in haddock_item or []:
+            names.append(item.name.strip('/'))
+            values.append(_haddock_metric(item,metric))
+            bands.append(_haddock_metric(item,metric,ci=True) if ci else None)
+
+        return {'_values':values,'_names':names,'_bands':bands}
 
-    names, values =[], []
-    for item in epoch_items:
-        hit = item.data_file[item.name+'/'+data_type+'/hit'].value
-        names.append(item.name.split('/')[-1])
-        values.append(func_operations[plot_type](hit))
-
-    data_dict = {'_values':values,'_names':names}
-    treeview.emitDict.emit(data_dict)
-
-    data_dict = {}
     cmd  = "%matplotlib inline\nimport matplotlib.pyplot as plt\n"
     cmd += "fig,ax = plt.subplots()\n"
-    cmd += "for v,n in zip(_values,_names):"
-    cmd += "    plt.plot(v,label=n)\n"
+    cmd += "for v,n,b in zip(_values,_names,_bands):\n"
+    cmd += "    line, = plt.plot(v,label=n)\n"
+    cmd += "    if b is not None:\n"
+    cmd += "        ax.fill_between(b[0]-1,b[1],b[2],color=line.get_color(),alpha=0.2)\n"
     cmd += "legen = ax.legend(loc='lower right')\n"
     cmd += "ax.set_xlabel('Top M')\n"
     cmd += "ax.set_ylabel('%s')\n" %plot_type
     cmd += "plt.show()\n"
-    data_dict['exec_cmd'] = cmd
-    treeview.emitDict.emit(data_dict)
+    _run_task(treeview,'%s (%d epochs)' %(plot_type,len(epoch_items)+len(haddock_item or [])),_multiple_metric,cmd=cmd)
 
 
+def _losses_values(item):
+
+    values = []
+    train = as_array(item.data_file[item.name+'/train'])
+    valid = as_array(item.data_file[item.name+'/valid'])
+    values.append(train)
+    values.append(valid)
+
+    if 'test' in item.data_file[item.name]:
+        test = as_array(item.data_file[item.name+'/test'])
+        values.append(test)
+
+    return {'_values':values}
+
 def _context_losses(item,treeview,position):
 
     menu = QtWidgets.QMenu()
     actions = {}
-    list_operations = ['Plot Losses']
+    list_operations = ['Plot Losses'] + list(_best_epoch_metrics) + ['Export All Epochs'] + _follow_operations(item.data_file) + _task_operations()
 
     for operation in list_operations:
         actions[operation] = menu.addAction(operation)
-    action = menu.exec_(treeview.viewport().mapToGlobal(position))
+    with instrument.excluded('menu popup'):
+        action = menu.exec_(treeview.viewport().mapToGlobal(position))
 
-    if action == actions['Plot Losses']:
+    for op,metric in _best_epoch_metrics.items():
+        if action == actions[op]:
+            _best_epoch(item.data_file,treeview,metric)
 
-        values = []
-        train = item.data_file[item.name+'/train'].value
-        valid = item.data_file[item.name+'/valid'].value
-        values.append([x for x in train])
-        values.append([x for x in valid])
+    if action == actions['Export All Epochs']:
+        _export_columns(item.data_file,treeview)
 
-        if 'test' in item.data_file[item.name]:
-            test = item.data_file[item.name+'/test'].value
-            values.append([x for x in test])
+    _follow_actions(item.data_file,treeview,action,actions)
+
+    _task_actions(action,actions)
+
+    if action == actions['Plot Losses']:
 
-        data_dict = {'_values':values}
+        data_dict = _losses_values(item)
         treeview.emitDict.emit(data_dict)
 
         data_dict = {}
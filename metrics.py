@@ -0,0 +1,300 @@
+import os
+import threading
+import numpy as np
+import h5py
+
+def hitrate(hits):
+
+    """Hit rate of many epochs at once.
+
+    Same as rankingMetrics.hitrate along the last axis of hits (nepoch,ndecoys).
+    """
+
+    hits = np.atleast_2d(np.asarray(hits,dtype=np.float64))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.cumsum(hits,axis=-1)/np.sum(hits,axis=-1,keepdims=True)
+
+def avprec(hits):
+
+    """Average precision of many epochs at once.
+
+    Same as rankingMetrics.avprec, i.e. the average precision of the first
+    1 .. ndecoys-1 decoys, along the last axis of hits (nepoch,ndecoys).
+    """
+
+    rel = np.atleast_2d(np.asarray(hits)) != 0
+    nrel = np.cumsum(rel,axis=-1)
+    prec = nrel / np.arange(1,rel.shape[-1]+1)
+    sum_prec = np.cumsum(prec*rel,axis=-1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ap = np.where(nrel > 0,sum_prec/nrel,0.)
+    return ap[...,:-1]
+
+METRICS = {'hitrate':hitrate,'avprec':avprec}
+
+# bootstrap of the metric curves
+BOOTSTRAP_SAMPLES = int(os.environ.get('DEEPXPLORER_BOOTSTRAP_SAMPLES',1000))
+BOOTSTRAP_LEVEL = 0.95
+BOOTSTRAP_POINTS = 200
+
+def _sorted_nanquantile(values, q):
+
+    # quantile along axis 1 of sorted values, ignoring the nan sorted at the end
+    # (resamples without any hit have no hit rate), as np.nanquantile but vectorized
+    nvalid = np.sum(~np.isnan(values),axis=1)
+    pos = q*np.maximum(nvalid-1,0)
+    ilow = np.floor(pos).astype(int)
+    ihigh = np.minimum(ilow+1,np.maximum(nvalid-1,0))
+    low = np.take_along_axis(values,ilow[:,None],axis=1)[:,0]
+    high = np.take_along_axis(values,ihigh[:,None],axis=1)[:,0]
+    return np.where(nvalid > 0,low + (pos-ilow)*(high-low),np.nan)
+
+def bootstrap(hits, metric='hitrate', nboot=BOOTSTRAP_SAMPLES, level=BOOTSTRAP_LEVEL,
+              npoints=BOOTSTRAP_POINTS, chunk_size=2**22, seed=0):
+
+    """Bootstrap confidence band of the metric curves of many epochs at once.
+
+    The decoys are resampled with replacement, keeping their ranking order,
+    and the curves of all the resamples are computed in one operation. The
+    same resamples are used for all the epochs so that their bands can be
+    compared. The resamples and the epochs are processed by chunks of about
+    chunk_size values. Return (nepoch,3,npoints) : the ranks where the band
+    is evaluated, its lower and upper bound.
+    """
+
+    hits = np.atleast_2d(np.asarray(hits,dtype=np.float64))
+    nepoch, n = hits.shape
+    ncurve = n if metric == 'hitrate' else n-1
+    ranks = np.unique(np.linspace(1,ncurve,min(ncurve,npoints)).astype(int))
+
+    out = np.full((nepoch,3,len(ranks)),np.nan)
+    out[:,0] = ranks
+    if len(ranks) == 0:
+        return out
+
+    alpha = 100*(1-level)/2
+    nepoch_chunk = max(1,chunk_size//(nboot*len(ranks)))
+    for iepoch in range(0,nepoch,nepoch_chunk):
+
+        # the generator restarts for each chunk of epochs so they all see the same resamples
+        rng = np.random.default_rng(seed)
+        batch = hits[iepoch:iepoch+nepoch_chunk]
+        curves = np.empty((len(batch),nboot,len(ranks)),dtype=np.float32)
+
+        nboot_chunk = max(1,chunk_size//(len(batch)*n))
+        for istart in range(0,nboot,nboot_chunk):
+            nb = min(nboot_chunk,nboot-istart)
+            index = np.sort(rng.integers(0,n,(nb,n)),axis=1)
+            curves[:,istart:istart+nb] = METRICS[metric](batch[:,index])[...,ranks-1]
+
+        curves.sort(axis=1)
+        out[iepoch:iepoch+nepoch_chunk,1] = _sorted_nanquantile(curves,alpha/100)
+        out[iepoch:iepoch+nepoch_chunk,2] = _sorted_nanquantile(curves,1-alpha/100)
+
+    return out
+
+# number of top ranked decoys used for the hit rate of the best epoch
+TOP_M = 100
+
+def _epoch_score(h5file, path, split, metric, top_m, losses_path):
+
+    if metric == 'loss':
+        if losses_path is None or split not in h5file[losses_path]:
+            return np.nan
+        iepoch = int(path.split('_')[-1])
+        losses = h5file[losses_path+'/'+split]
+        return float(losses[iepoch]) if iepoch < len(losses) else np.nan
+
+    hit_path = path.rstrip('/') + '/' + split + '/hit'
+    if hit_path not in h5file:
+        return np.nan
+    hit = h5file[hit_path][()]
+    if len(hit) == 0:
+        return np.nan
+
+    # deeprank.learn loads torch, only import it when needed
+    from deeprank.learn import rankingMetrics
+    if metric == 'hitrate':
+        return float(rankingMetrics.hitrate(hit)[min(top_m,len(hit))-1])
+    elif metric == 'avprec':
+        return float(rankingMetrics.average_precision(hit))
+    else:
+        raise ValueError('Metric %s not recognized' %metric)
+
+def run_losses(epoch_path, losses_paths):
+
+    """Losses group of the run of an epoch among losses_paths.
+
+    In a view of several runs (/runA/epoch_0010, /runA/losses, /runB/...)
+    the losses of an epoch are the ones of the deepest group containing it.
+    """
+
+    best, depth = None, -1
+    for lpath in losses_paths:
+        run = os.path.dirname(lpath.rstrip('/')).rstrip('/') + '/'
+        if epoch_path.startswith(run) and len(run) > depth:
+            best, depth = lpath, len(run)
+    return best
+
+def epoch_scores(h5file, path, metric='hitrate', top_m=TOP_M, losses_path=None):
+    return [_epoch_score(h5file,path,split,metric,top_m,losses_path) for split in ['train','valid','test']]
+
+def rank_epochs(h5file, epoch_paths, metric='hitrate', sort_by='valid', top_m=TOP_M, losses_paths=()):
+
+    """Rank the epochs by hit rate at top M, average precision or loss.
+
+    The epochs are read one at a time and only their scores are kept. The
+    losses of each epoch are taken in the losses group of its run (see
+    run_losses). Return a structured array (epoch,train,valid,test) with
+    the full path of the epochs, sorted from the best epoch to the worst
+    one on the sort_by split.
+    """
+
+    rows = []
+    for path in epoch_paths:
+        losses_path = run_losses(path,losses_paths)
+        rows.append(tuple([path] + epoch_scores(h5file,path,metric,top_m,losses_path)))
+
+    width = max([len(r[0]) for r in rows] + [1])
+    table = np.array(rows,dtype=[('epoch','U%d' %width),('train','f8'),('valid','f8'),('test','f8')])
+
+    # the nan go at the end in both cases
+    if metric == 'loss':
+        order = np.argsort(table[sort_by],kind='stable')
+    else:
+        order = np.argsort(-table[sort_by],kind='stable')
+    return table[order]
+
+def regression_stats(targets, outputs):
+
+    """Number of points, Pearson correlation, RMSE and MAE of the predictions."""
+
+    x = np.asarray(targets,dtype=np.float64).ravel()
+    y = np.asarray(outputs,dtype=np.float64).ravel()
+    n = len(x)
+    if n == 0:
+        return {'n':0,'pearson':np.nan,'rmse':np.nan,'mae':np.nan}
+
+    dx, dy = x-x.mean(), y-y.mean()
+    sxx, syy, sxy = np.dot(dx,dx), np.dot(dy,dy), np.dot(dx,dy)
+    err = y-x
+    with np.errstate(divide='ignore',invalid='ignore'):
+        pearson = sxy/np.sqrt(sxx*syy)
+
+    return {'n':n,'pearson':float(pearson),'rmse':float(np.sqrt(np.dot(err,err)/n)),'mae':float(np.mean(np.abs(err)))}
+
+class MetricEngine(object):
+
+    def __init__(self, h5file, sidecar=None):
+        """Compute the ranking metrics of many epochs and memoize them.
+
+        The metrics are stored in a sidecar file (by default <file>.metrics.hdf5)
+        under <epoch path>/<split>/<metric>. The sidecar is cleared when the
+        source file changes. If the sidecar can't be written the metrics are
+        only kept in memory.
+        """
+
+        self.h5file = h5file
+        fname = os.path.abspath(h5file.filename)
+        if sidecar is None:
+            sidecar = os.path.splitext(fname)[0] + '.metrics.hdf5'
+        self.sidecar = sidecar
+
+        stat = os.stat(fname)
+        self.version = '%d_%d' %(stat.st_mtime_ns,stat.st_size)
+
+        self.memory = {}
+        self.lock = threading.Lock()
+        self._check_sidecar()
+
+    def _check_sidecar(self):
+        try:
+            with h5py.File(self.sidecar,'a') as f5:
+                if f5.attrs.get('version',None) != self.version:
+                    for k in list(f5.keys()):
+                        del f5[k]
+                    f5.attrs['version'] = self.version
+        except (OSError,IOError):
+            print('-- Metrics of %s are not cached on disk' %self.h5file.filename)
+            self.sidecar = None
+
+    def _load(self, keys):
+        out = {k:self.memory[k] for k in keys if k in self.memory}
+        if self.sidecar is not None:
+            with h5py.File(self.sidecar,'r') as f5:
+                for k in keys:
+                    if k not in out and k in f5:
+                        out[k] = f5[k][()]
+                        self.memory[k] = out[k]
+        return out
+
+    def _store(self, results):
+        self.memory.update(results)
+        if self.sidecar is not None:
+            with h5py.File(self.sidecar,'a') as f5:
+                for k,v in results.items():
+                    if k in f5:
+                        del f5[k]
+                    f5.create_dataset(k,data=v)
+
+    def compute(self, epoch_paths, split, metric):
+
+        """Metric of the given split for all the epochs.
+
+        Return a list with one array per epoch (None if the epoch has no such split).
+        """
+
+        return self._compute(epoch_paths,split,metric,METRICS[metric])
+
+    def compute_ci(self, epoch_paths, split, metric, nboot=BOOTSTRAP_SAMPLES, level=BOOTSTRAP_LEVEL):
+
+        """Bootstrap confidence band of the metric for all the epochs.
+
+        Return a list with one (3,npoints) array per epoch (see bootstrap).
+        """
+
+        name = '%s_ci_%d_%d' %(metric,nboot,round(100*level))
+        return self._compute(epoch_paths,split,name,lambda hits: bootstrap(hits,metric,nboot,level))
+
+    def _compute(self, epoch_paths, split, name, func):
+
+        keys = ['%s/%s/%s' %(p.strip('/'),split,name) for p in epoch_paths]
+
+        with self.lock:
+            results = self._load(keys)
+
+            # read the hits of the missing epochs
+            # and stack the ones with the same number of decoys
+            todo = {}
+            for path,key in zip(epoch_paths,keys):
+                if key in results:
+                    continue
+                hit_path = path.rstrip('/') + '/' + split + '/hit'
+                if hit_path not in self.h5file:
+                    continue
+                hit = self.h5file[hit_path][()]
+                todo.setdefault(hit.shape,[]).append((key,hit))
+
+            new = {}
+            for _,batch in todo.items():
+                values = func(np.stack([h for _,h in batch]))
+                for (key,_),v in zip(batch,values):
+                    new[key] = v
+
+            if len(new) > 0:
+                self._store(new)
+            results.update(new)
+
+        return [results.get(k,None) for k in keys]
+
+
+# one engine per opened file
+_engines = {}
+
+def get_metric_engine(h5file):
+
+    engine = _engines.get(h5file.filename,None)
+    if engine is None or engine.h5file != h5file:
+        engine = MetricEngine(h5file)
+        _engines[h5file.filename] = engine
+    return engine
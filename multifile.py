@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import os
+import json
+import h5py
+
+def _version(fname):
+    stat = os.stat(fname)
+    return '%d_%d' %(stat.st_mtime_ns,stat.st_size)
+
+def _labels(fnames):
+
+    # one top level group per file named after it
+    labels = []
+    for fname in fnames:
+        base = os.path.splitext(os.path.basename(fname))[0]
+        label, i = base, 1
+        while label in labels:
+            label = '%s_%d' %(base,i)
+            i += 1
+        labels.append(label)
+    return labels
+
+def _add_dataset(view, path, dset, fname):
+
+    # the data stay in the source file, the view only maps them
+    # the datasets that can't be virtual (variable length, empty) are linked
+    if dset.dtype.kind != 'O' and dset.size > 0 and dset.shape != ():
+        layout = h5py.VirtualLayout(shape=dset.shape,dtype=dset.dtype)
+        layout[...] = h5py.VirtualSource(fname,dset.name,shape=dset.shape)
+        view.create_virtual_dataset(path,layout)
+        for k,v in dset.attrs.items():
+            view[path].attrs[k] = v
+    else:
+        view[path] = h5py.ExternalLink(fname,dset.name)
+
+def build_view(fnames, view_fname, labels=None):
+
+    """Merge several files (trainings, baselines) in one view file.
+
+    The content of each file is put under a group named after the file
+    (/<label>/epoch_0000 ...). The groups and their attributes are created
+    in the view, the datasets are virtual datasets mapping the ones of the
+    source files so that no data is copied.
+    """
+
+    fnames = [os.path.abspath(f) for f in fnames]
+    if labels is None:
+        labels = _labels(fnames)
+
+    with h5py.File(view_fname,'w') as view:
+
+        sources = {}
+        for label,fname in zip(labels,fnames):
+            sources[label] = {'file':fname,'version':_version(fname)}
+            top = view.create_group(label)
+
+            with h5py.File(fname,'r') as src:
+                for k,v in src.attrs.items():
+                    top.attrs[k] = v
+
+                def _add(name,obj):
+                    path = label + '/' + name
+                    if isinstance(obj,h5py.Group):
+                        grp = view.create_group(path)
+                        for k,v in obj.attrs.items():
+                            grp.attrs[k] = v
+                    else:
+                        _add_dataset(view,path,obj,fname)
+
+                src.visititems(_add)
+
+        view.attrs['type'] = 'view'
+        view.attrs['sources'] = json.dumps(sources)
+
+    return view_fname
+
+def view_sources(view_fname):
+    with h5py.File(view_fname,'r') as view:
+        return json.loads(view.attrs['sources'])
+
+def is_stale(view_fname, fnames=None):
+
+    """True if the view does not exist, does not map fnames or a source changed."""
+
+    if not os.path.isfile(view_fname):
+        return True
+    try:
+        sources = view_sources(view_fname)
+    except (OSError,KeyError,ValueError):
+        return True
+
+    if fnames is not None and sorted(os.path.abspath(f) for f in fnames) != sorted(s['file'] for s in sources.values()):
+        return True
+    for s in sources.values():
+        if not os.path.isfile(s['file']) or _version(s['file']) != s['version']:
+            return True
+    return False
+
+def open_view(fnames, view_fname='compare.hdf5'):
+
+    """Open the view of the files, rebuilt if one of them changed."""
+
+    if is_stale(view_fname,fnames):
+        build_view(fnames,view_fname)
+    return h5py.File(view_fname,'r')
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge several deeprank HDF5 files in one view to compare them in DeepXplorer')
+    parser.add_argument('hdf5',nargs='+',help='training outputs and baselines (e.g. haddockScoreBM4.hdf5)')
+    parser.add_argument('-o','--output',default='compare.hdf5',help='view file')
+    args = parser.parse_args()
+
+    if is_stale(args.output,args.hdf5):
+        build_view(args.hdf5,args.output)
+    for label,s in view_sources(args.output).items():
+        print('-- /%s : %s' %(label,s['file']))
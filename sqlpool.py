@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+
+# default memory budget of the pool in MB
+DEFAULT_POOL_SIZE = 256
+
+# rough memory footprint of one atom in the sqlite database
+BYTES_PER_ATOM = 1000
+
+class SQLPool(object):
+
+    def __init__(self, max_size=None, max_entries=16):
+        """LRU pool of the pdb2sql databases of the molecules.
+
+        The databases are keyed by the source file, its version (mtime and
+        size) and the molecule path. The memory used by a database is
+        estimated from its number of atoms, the least recently used ones are
+        closed when the pool exceeds max_size (in MB, default to
+        $DEEPXPLORER_SQL_POOL_SIZE or 256) or max_entries.
+
+        A sqlite connection can only be used in the thread that created it,
+        the databases are therefore also keyed by thread. The databases of
+        other threads evicted from the pool are closed by their thread the
+        next time it uses the pool.
+
+        There is one pool per process: in the browser it serves the PDB2SQL
+        action, in a worker process the PDB export and the contact atoms of
+        the molecules exported by this process. The two can't share the
+        databases as the exports run in separate processes.
+        """
+
+        if max_size is None:
+            max_size = float(os.environ.get('DEEPXPLORER_SQL_POOL_SIZE',DEFAULT_POOL_SIZE))
+        self.max_size = max_size
+        self.max_entries = max_entries
+
+        # {key : [db,size,pinned]}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # {thread id : [entries evicted by another thread]}
+        self.closing = {}
+
+    @staticmethod
+    def get_key(molgrp):
+        fname = os.path.abspath(molgrp.file.filename)
+        stat = os.stat(fname)
+        return (threading.get_ident(),fname,'%d_%d' %(stat.st_mtime_ns,stat.st_size),molgrp.name)
+
+    def get(self, molgrp, pin=False):
+
+        """Database of the molecule, created if needed.
+
+        Pinned databases are handed out (e.g. to the console) and are only
+        dropped from the pool on eviction, not closed.
+        """
+
+        key = self.get_key(molgrp)
+        with self.lock:
+            for entry in self.closing.pop(key[0],[]):
+                self._close(entry)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                entry = self.entries[key]
+                entry[2] |= pin
+                return entry[0]
+
+        from pdb2sql import interface
+        complex_data = molgrp['complex'][()]
+        db = interface(complex_data)
+        size = len(complex_data)*BYTES_PER_ATOM/1024**2
+
+        with self.lock:
+            self.entries[key] = [db,size,pin]
+            self._evict(keep=[key])
+        return db
+
+    def size(self):
+        return sum(size for _,size,_ in self.entries.values())
+
+    def _evict(self, keep=()):
+
+        # drop the least recently used databases until the pool is within
+        # its budget (called with the lock held), the databases of this thread
+        # are closed now, the other ones by their thread if it is still running
+        ident = threading.get_ident()
+        alive = set(t.ident for t in threading.enumerate())
+        for key in list(self.entries.keys()):
+            if self.size() <= self.max_size and len(self.entries) <= self.max_entries:
+                break
+            if key in keep:
+                continue
+            entry = self.entries.pop(key)
+            if key[0] == ident:
+                self._close(entry)
+            elif key[0] in alive:
+                self.closing.setdefault(key[0],[]).append(entry)
+
+    @staticmethod
+    def _close(entry):
+        db,_,pinned = entry
+        if not pinned:
+            db._close()
+
+    def clear(self):
+        with self.lock:
+            ident = threading.get_ident()
+            for entry in self.closing.pop(ident,[]):
+                self._close(entry)
+            for key in [k for k in self.entries if k[0] == ident]:
+                self._close(self.entries.pop(key))
+
+
+# one pool per process
+_pool = None
+
+def get_sql_pool():
+    global _pool
+    if _pool is None:
+        _pool = SQLPool()
+    return _pool
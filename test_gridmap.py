@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import gridmap
+
+def _full_grid(grid, pos, kernel, param, cutoff):
+
+    # reference: the kernel of each atom evaluated on the whole grid
+    x, y, z = np.meshgrid(grid['x'],grid['y'],grid['z'],indexing='ij')
+    param = np.broadcast_to(np.asarray(param,dtype=np.float64),(len(pos),))
+    data = np.zeros(x.shape)
+    for p, v in zip(pos,param):
+        dd = np.sqrt((x-p[0])**2 + (y-p[1])**2 + (z-p[2])**2)
+        data += np.where(dd < cutoff,kernel(dd,v),0.)
+    return data
+
+def _grid(res):
+    return {'x':np.arange(-4.,4.+1e-6,res[0]),'y':np.arange(-3.,5.+1e-6,res[1]),'z':np.arange(0.,6.+1e-6,res[2])}
+
+def _positions(grid, n=40):
+
+    # atoms inside, on and near the edges and outside of the grid
+    rng = np.random.default_rng(n)
+    low = np.array([grid[k][0] for k in 'xyz'])
+    high = np.array([grid[k][-1] for k in 'xyz'])
+    inside = rng.uniform(low,high,(n,3))
+    edges = np.array([low,high,low-0.3,high+0.3,low-4.,high+7.,[low[0]-1.,0.,high[2]+2.]])
+    return np.vstack([inside,edges])
+
+@pytest.mark.parametrize('res',[(1.,1.,1.),(0.5,0.7,1.2)])
+@pytest.mark.parametrize('chunk_size',[2**22,1000])
+def test_map_values(res, chunk_size):
+    grid = _grid(res)
+    pos = _positions(grid)
+    values = np.random.default_rng(1).standard_normal(len(pos))
+    data = gridmap.map_points(grid,pos,gridmap.feature_kernel,values,gridmap.FEATURE_CUTOFF,chunk_size=chunk_size)
+    ref = _full_grid(grid,pos,gridmap.feature_kernel,values,gridmap.FEATURE_CUTOFF)
+    assert data.shape == ref.shape
+    assert np.allclose(data,ref)
+
+@pytest.mark.parametrize('res',[(1.,1.,1.),(0.5,0.7,1.2)])
+@pytest.mark.parametrize('vdw_radius',[1.7,3.2])
+def test_map_densities(res, vdw_radius):
+    grid = _grid(res)
+    pos = _positions(grid)
+    data = gridmap.map_densities(grid,pos,vdw_radius)
+    ref = _full_grid(grid,pos,gridmap.density_kernel,vdw_radius,gridmap.density_cutoff(vdw_radius))
+    assert np.allclose(data,ref)
+
+def test_map_empty():
+    grid = _grid((1.,1.,1.))
+    assert not gridmap.map_values(grid,np.zeros((0,3)),np.zeros(0)).any()
@@ -0,0 +1,155 @@
+import os
+import socket
+import socketserver
+import threading
+from xmlrpc.server import SimpleXMLRPCServer
+import h5py
+import numpy as np
+import pytest
+import featstats
+import viztools
+
+@pytest.fixture
+def pymol_server():
+
+    # stand-in of the XML-RPC server of pymol -R
+    received = []
+    server = SimpleXMLRPCServer(('localhost',0),logRequests=False)
+    server.register_function(lambda: 1,'ping')
+    server.register_function(lambda cmd: received.append(cmd) or 0,'do')
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    yield server.server_address[1], received
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def vmd_server():
+
+    # stand-in of the Tcl server, one command and one answer per line
+    received = []
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode().rstrip('\n')
+                received.append(line)
+                self.wfile.write(('ok %s\n' %line).encode())
+                self.wfile.flush()
+
+    server = socketserver.ThreadingTCPServer(('localhost',0),Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    yield server.server_address[1], received
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sessions(pymol_server, vmd_server, monkeypatch):
+    _sessions = {'pymol':viztools.PyMolSession(port=pymol_server[0],start=False),
+                 'vmd':viztools.VMDSession(port=vmd_server[0],start=False,timeout=5)}
+    monkeypatch.setattr(viztools,'_sessions',_sessions)
+    return {'pymol':pymol_server[1],'vmd':vmd_server[1]}
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost',0))
+        return sock.getsockname()[1]
+
+def _export_dir(root, name, features=('C_chainA','O_chainB')):
+    path = root.mkdir(name)
+    path.join('complex.pdb').write('END\n')
+    for f in features:
+        path.join(f + '.cube').write('')
+    return str(path) + '/'
+
+def test_pymol_send(pymol_server):
+    port, received = pymol_server
+    session = viztools.PyMolSession(port=port,start=False)
+    assert session.alive()
+    assert session.send(['load a.pdb','show sticks']) == [0,0]
+    assert received == ['load a.pdb','show sticks']
+
+def test_vmd_send(vmd_server):
+    port, received = vmd_server
+    session = viztools.VMDSession(port=port,start=False,timeout=5)
+    assert session.send(['cd {/tmp}','source loadData.vmd']) == ['ok cd {/tmp}','ok source loadData.vmd']
+    assert received == ['version','cd {/tmp}','source loadData.vmd']
+
+@pytest.mark.parametrize('session_class',[viztools.PyMolSession,viztools.VMDSession])
+def test_no_viewer(session_class):
+    session = session_class(port=_free_port(),start=False,timeout=1)
+    assert not session.alive()
+    with pytest.raises(RuntimeError):
+        session.send(['version'])
+
+def test_pymol_commands(tmpdir):
+    path = _export_dir(tmpdir,'1AK4_10w_0123abcd')
+    cmds = viztools.pymol_commands(path,'cube')
+    assert cmds[0] == 'load %scomplex.pdb, 1AK4_10w_complex' %path
+    assert 'load %sC_chainA.cube, 1AK4_10w_C_chainA' %path in cmds
+    assert 'isosurface neg_1AK4_10w_O_chainB, 1AK4_10w_O_chainB, -0.05' in cmds
+    assert cmds[-3] == 'group 1AK4_10w, 1AK4_10w_* pos_1AK4_10w_* neg_1AK4_10w_*'
+    assert cmds[-1] == 'enable 1AK4_10w_complex'
+
+def test_launch_molecules_pymol(tmpdir, sessions):
+    paths = [_export_dir(tmpdir,'molA_0123'),_export_dir(tmpdir,'molB_4567')]
+    viztools.launch_molecules(paths,'pymol','cube')
+    received = sessions['pymol']
+    assert received == viztools.pymol_commands(paths[0],'cube') + viztools.pymol_commands(paths[1],'cube') + ['set grid_mode, 1']
+
+def test_launch_molecules_vmd(tmpdir, sessions):
+    paths = [_export_dir(tmpdir,'molA_0123'),_export_dir(tmpdir,'molB_4567')]
+    viztools.launch_molecules(paths,'vmd','cube')
+    received = [c for c in sessions['vmd'] if c != 'version']
+    assert received == ['cd {%s}' %os.path.abspath(paths[0]),'source loadData.vmd',
+                        'cd {%s}' %os.path.abspath(paths[1]),'source loadData.vmd']
+    assert all(os.path.isfile(p + 'loadData.vmd') for p in paths)
+
+def test_pymol_commands_levels(tmpdir):
+    path = _export_dir(tmpdir,'1AK4_10w_0123abcd')
+    with open(path + 'levels.json','w') as f:
+        f.write('{"C_chainA": [-0.25, 0.5]}')
+    cmds = viztools.pymol_commands(path,'cube')
+    assert 'isosurface pos_1AK4_10w_C_chainA, 1AK4_10w_C_chainA, 0.5' in cmds
+    assert 'isosurface neg_1AK4_10w_C_chainA, 1AK4_10w_C_chainA, -0.25' in cmds
+    assert 'isosurface pos_1AK4_10w_O_chainB, 1AK4_10w_O_chainB, 0.05' in cmds
+
+def _mapped_file(fname):
+
+    # two molecules, the same feature name in two groups
+    f5 = h5py.File(fname,'w')
+    rng = np.random.default_rng(0)
+    for mol in ['molA','molB']:
+        molgrp = f5.create_group(mol)
+        molgrp.attrs['type'] = 'molecule'
+        for k in 'xyz':
+            molgrp['grid_points/' + k] = np.arange(8.)
+        for data_name,scale in [('Feature_ind',1.),('Other_ind',100.)]:
+            subgrp = molgrp.create_group('mapped_features/%s/C_chainA' %data_name)
+            subgrp.attrs['sparse'] = False
+            subgrp['value'] = scale*rng.standard_normal((8,8,8))
+    return f5
+
+def test_isosurface_levels(tmpdir):
+
+    path = _export_dir(tmpdir,'molA_0123')
+    sidecar = str(tmpdir.join('mapped.features.hdf5'))
+    with _mapped_file(str(tmpdir.join('mapped.hdf5'))) as f5:
+
+        # the file is not scanned for the levels
+        index = featstats.FeatureIndex(f5,sidecar=sidecar,lod_levels=(2,))
+        assert viztools.write_isosurface_levels(path,f5['molA'],index) == {}
+        assert index.cached() is None
+
+        # the levels of the feature of the first group at the exported level of detail
+        index.build()
+        for lod in [1,2]:
+            levels = viztools.write_isosurface_levels(path,f5['molA'],index,lod)
+            pos = index.quantile('Feature_ind/C_chainA',viztools.ISO_QUANTILE,lod)
+            assert list(levels) == ['C_chainA'] and levels['C_chainA'][1] == pos
+        assert levels['C_chainA'][1] < index.quantile('Feature_ind/C_chainA',viztools.ISO_QUANTILE)
+        assert viztools.read_isosurface_levels(path) == levels
+
+        # the sidecar is used by a new index
+        index = featstats.FeatureIndex(f5,sidecar=sidecar,lod_levels=(2,))
+        assert viztools.write_isosurface_levels(path,f5['molA'],index,2) == levels
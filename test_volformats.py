@@ -0,0 +1,70 @@
+import io
+import os
+import numpy as np
+import pytest
+import volformats
+from volformats import write_cube_values, write_sparse_cube_values
+
+def _loop_cube_values(values):
+
+    # writer of the cube values before the vectorization
+    f = io.StringIO()
+    npts = values.shape
+    last_char_check = True
+    for i in range(npts[0]):
+        for j in range(npts[1]):
+            for k in range(npts[2]):
+                f.write(" %11.5e" % values[i,j,k])
+                last_char_check = True
+                if k % 6 == 5:
+                    f.write("\n")
+                    last_char_check = False
+            if last_char_check:
+                f.write("\n")
+    return f.getvalue()
+
+def _grid(nz, dtype):
+    rng = np.random.default_rng(nz)
+    return (rng.standard_normal((4,3,nz))*10.**rng.integers(-3,3,(4,3,nz))).astype(dtype)
+
+@pytest.mark.parametrize('dtype',[np.float32,np.float64])
+@pytest.mark.parametrize('nz',[1,6,7,13])
+@pytest.mark.parametrize('chunk_size',[2**20,5])
+def test_cube_values(nz, dtype, chunk_size):
+    values = _grid(nz,dtype)
+    f = io.StringIO()
+    write_cube_values(f,values,chunk_size=chunk_size)
+    assert f.getvalue() == _loop_cube_values(values)
+
+@pytest.mark.parametrize('dtype',[np.float32,np.float64])
+@pytest.mark.parametrize('nz',[1,6,7,13])
+@pytest.mark.parametrize('chunk_size',[2**20,5])
+def test_sparse_cube_values(nz, dtype, chunk_size):
+
+    values = _grid(nz,dtype)
+    values[values < 0] = 0
+    index = np.flatnonzero(values)
+
+    # the writer sorts the points itself
+    order = np.random.default_rng(0).permutation(len(index))
+    f = io.StringIO()
+    write_sparse_cube_values(f,index[order],values.ravel()[index][order],values.shape,chunk_size=chunk_size)
+    assert f.getvalue() == _loop_cube_values(values)
+
+    # (n,3) index
+    f = io.StringIO()
+    write_sparse_cube_values(f,np.argwhere(values),values[values != 0],values.shape,chunk_size=chunk_size)
+    assert f.getvalue() == _loop_cube_values(values)
+
+@pytest.mark.parametrize('fmt',['cube','ccp4.gz'])
+def test_write_volume_error(tmpdir, monkeypatch, fmt):
+
+    def fail(f, values, grid):
+        raise RuntimeError('writer failed')
+
+    monkeypatch.setitem(volformats.FORMATS,fmt,dict(volformats.FORMATS[fmt],write=fail))
+    fname = str(tmpdir.join('C_chainA.' + fmt))
+    grid = {k:np.arange(3.) for k in 'xyz'}
+    with pytest.raises(RuntimeError):
+        volformats.write_volume(fname,np.zeros((3,3,3)),grid,fmt)
+    assert os.listdir(str(tmpdir)) == []
@@ -1,61 +1,118 @@
 #!/usr/bin/env python
 
 import numpy as  np
-import argparse
 import subprocess as sp
 import os
-import pickle
+import fnmatch
+import multiprocessing
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import xmlrpc.client
+import json
 import h5py
-from pdb2sql import pdb2sql
-from deeprank.tools import sparse
-from deeprank.learn import DataSet
+from export_cache import ExportCache
+from sqlpool import get_sql_pool
+import instrument
+import gridmap
+import volformats
+
+# atomic densities mapped when the molecule has no mapped_features {element : vdw radius}
+ATOMIC_DENSITIES = {'CA':3.5, 'C':3.5, 'N':3.5, 'O':3.5}
+
+# format of the exported grids (see volformats.FORMATS)
+VOLUME_FORMAT = os.environ.get('DEEPXPLORER_VOLUME_FORMAT','cube')
+
+# levels of detail of the previews, each level is factor times coarser
+LOD_LEVELS = (2,4)
+LOD_MODE = os.environ.get('DEEPXPLORER_LOD_MODE','mean')
+
+# grids with more points are shown as a preview first
+PREVIEW_MAX_POINTS = int(os.environ.get('DEEPXPLORER_PREVIEW_MAX_POINTS',40**3))
+
+# isosurfaces of the features, default levels and quantile of the values
+# over all the molecules of the file used as level (see featstats.FeatureIndex)
+ISO_LEVEL = 0.05
+ISO_LEVEL_VMD = 0.02
+ISO_QUANTILE = float(os.environ.get('DEEPXPLORER_ISO_QUANTILE',0.99))
+
+# push the molecules in one running viewer instead of a new viewer per molecule
+VIEWER_SESSION = os.environ.get('DEEPXPLORER_VIEWER_SESSION','1') == '1'
+
+def create3Ddata(mol_name, molgrp, root='./_tmp_h5x/', cache_size=None, sparse_write=False,
+                 npts=(30,30,30), res=(1,1,1), nthreads=None, fmt=VOLUME_FORMAT, lod=1, evict=True):
+
+    # get the cache entry of the molecule
+    # the coarser levels have their own entries
+    cache = ExportCache(root,max_size=cache_size)
+    params = {'npts':list(npts),'res':list(res)}
+    if lod > 1:
+        mol_name += '_lod%d' %lod
+        params['lod'] = [lod,LOD_MODE]
+    outdir = cache.get_dir(mol_name,molgrp,params=params)
 
-def create3Ddata(mol_name, molgrp, root='./_tmp_h5x/'):
-    
-    if not os.path.isdir(root):
-        os.mkdir(root)
-
-    outdir = root + mol_name + '/'
-    if not os.path.isdir(outdir):
-        os.mkdir(outdir)
-    
     # create the pdb file
     pdb_name = outdir + 'complex.pdb'
     if not os.path.isfile(pdb_name):
-        sqldb = pdb2sql(molgrp['complex'].value)
-        sqldb.exportpdb(pdb_name)
-        sqldb._close()
+        instrument.progress('pdb export')
+        with instrument.phase('pdb export'):
+            sqldb = get_sql_pool().get(molgrp)
+            sqldb.exportpdb(pdb_name + '.part')
+            os.replace(pdb_name + '.part',pdb_name)
 
     # get the grid
-    grid = get_points(molgrp)
+    with instrument.phase('grid points'):
+        grid = get_points(molgrp,npts=npts,res=res)
+
+    # the features already exported are neither read nor mapped again
+    ext = volformats.FORMATS[fmt]['ext']
+    exported = [f[:-len(ext)] for f in os.listdir(outdir) if f.endswith(ext)]
 
     # deals with the features
     if 'mapped_features' in molgrp:
         print('-- Get existing features')
-        data_dict = get_feature(molgrp)
+
+        # stream the features one by one
+        # the sparse features are downsampled without densifying them
+        shape = tuple(len(grid[k]) for k in 'xyz')
+        data_dict = iter_feature(molgrp,densify=not sparse_write and lod == 1,skip=exported,shape=shape)
 
     else:
         print('-- Map existing features')
-        data_dict = map_feature(molgrp)
+        data_dict = map_feature(molgrp,grid=grid,nthreads=nthreads,skip=exported)
+
+    if lod > 1:
+        grid = gridmap.downsample_grid(grid,lod)
+        data_dict = iter_downsampled(data_dict,lod)
+
+    # export the grids
+    export_volume_files(data_dict,grid,outdir,fmt)
+
+    # keep the cache within its budget
+    # (the batch export evicts once all the molecules are exported)
+    if evict:
+        with instrument.phase('cache eviction'):
+            cache.evict(keep=[outdir])
 
-    # export the cube file
-    export_cube_files(data_dict,grid,outdir)
+    return outdir
 
 
-def get_points(mol_data):
+def get_points(mol_data, npts=(30,30,30), res=(1,1,1)):
 
 
     try:
 
-        x = mol_data['grid_points/x'].value
-        y = mol_data['grid_points/y'].value
-        z = mol_data['grid_points/z'].value
+        x = mol_data['grid_points/x'][()]
+        y = mol_data['grid_points/y'][()]
+        z = mol_data['grid_points/z'][()]
 
     except:
 
-        center = mol_data['grid_points/center'].value
-        npts = np.array([30,30,30])
-        res = np.array([1,1,1])
+        center = mol_data['grid_points/center'][()]
+        npts = np.array(npts)
+        res = np.array(res)
 
         halfdim = 0.5*(npts*res)
 
@@ -70,126 +127,203 @@ def get_points(mol_data):
 
 
 def get_feature(molgrp):
+    return dict(iter_feature(molgrp))
 
-    nx = len(molgrp['grid_points/x'])
-    ny = len(molgrp['grid_points/y'])
-    nz = len(molgrp['grid_points/z'])
-    shape = (nx,ny,nz)
+def iter_feature(molgrp, densify=True, skip=(), shape=None):
+
+    # deeprank is only loaded when the features are used
+    from deeprank.tools import sparse
+
+    # the shape of the grid if the caller has already read it
+    if shape is None:
+        nx = len(molgrp['grid_points/x'])
+        ny = len(molgrp['grid_points/y'])
+        nz = len(molgrp['grid_points/z'])
+        shape = (nx,ny,nz)
 
     mapgrp = molgrp['mapped_features']
-    data_dict = {}
 
     # loop through all the features
+    # and yield them one at a time {name : value}
     for data_name in mapgrp.keys():
 
-        # create a dict of the feature {name : value}
         featgrp = mapgrp[data_name]
 
         for ff in featgrp.keys():
+
+            # do not read the features we don't need
+            if ff in skip:
+                continue
+
             subgrp = featgrp[ff]
             if not subgrp.attrs['sparse']:
-                data_dict[ff] =  subgrp['value'].value
+                with instrument.phase('hdf5 read'):
+                    value = subgrp['value'][()]
+                yield ff, value
             else:
-                spg = sparse.FLANgrid(sparse=True,index=subgrp['index'].value,value=subgrp['value'].value,shape=shape)
-                data_dict[ff] =  spg.to_dense()
-
-    return data_dict
-
-def map_feature(molgrp):
-
-
-    ds = DataSet(None,grid_info={'number_of_points':(30,30,30),'resolution':(1,1,1)},process=False)
-
-    feature_list = {}
-    feature_list['AtomicDensities'] = {'CA':3.5, 'C':3.5, 'N':3.5, 'O':3.5}
-    feature_list['Features'] = list(molgrp['features'].keys())
-
-    grid, npts = ds.get_grid(molgrp)
-
-    data_dict = {}
-    for feat_type,feat_names in feature_list.items():
-
-        if feat_type == 'AtomicDensities':
-            data = ds.map_atomic_densities(feat_names, molgrp, grid, npts, None, None)
-
-            k = 0
-            for atom_name in ['CA','CB','N','O']:
-                for chain in ['_chainA', '_chainB']:
-                    data_dict[atom_name+chain] = data[k]
-                    k+=1
+                with instrument.phase('hdf5 read'):
+                    spg = sparse.FLANgrid(sparse=True,index=subgrp['index'][()],value=subgrp['value'][()],shape=shape)
+                if densify:
+                    with instrument.phase('densify'):
+                        value = spg.to_dense()
+                    yield ff, value
+                else:
+                    yield ff, spg
+
+def iter_downsampled(data_dict, factor, mode=None):
+
+    # coarser version of the features, one at a time
+    if mode is None:
+        mode = LOD_MODE
+    if isinstance(data_dict,dict):
+        data_dict = data_dict.items()
+
+    for name,values in data_dict:
+        with instrument.phase('downsample'):
+            if hasattr(values,'to_dense'):
+                values = gridmap.downsample_sparse(values.index,values.value,values.shape,factor,mode)
+            else:
+                values = gridmap.downsample(values,factor,mode)
+        yield name, values
+
+def preview_level(molgrp, npts=(30,30,30)):
+
+    # smallest level of detail with at most PREVIEW_MAX_POINTS points
+    if 'grid_points/x' in molgrp:
+        npts = [molgrp['grid_points/'+k].shape[0] for k in 'xyz']
+    for lod in (1,) + tuple(LOD_LEVELS):
+        if np.prod([-(-n//lod) for n in npts]) <= PREVIEW_MAX_POINTS:
+            return lod
+    return LOD_LEVELS[-1]
+
+def map_feature(molgrp, grid=None, nthreads=None, skip=()):
+
+    if grid is None:
+        grid = get_points(molgrp)
+
+    jobs = []
+
+    # atomic densities of the contact atoms
+    # the contacts are only searched if one of the densities is needed
+    densities = [(element+'_chain'+chain,element,vdw_rad,chain)
+                 for element,vdw_rad in ATOMIC_DENSITIES.items() for chain in ['A','B']]
+    densities = [d for d in densities if d[0] not in skip]
+    if len(densities) > 0:
+        with instrument.phase('contact atoms'):
+            sql = get_sql_pool().get(molgrp)
+            index = sql.get_contact_atoms(chain1='A',chain2='B')
+            for name,element,vdw_rad,chain in densities:
+                xyz = np.array(sql.get('x,y,z',rowID=index[chain],element=element)).reshape(-1,3)
+                jobs.append((name,gridmap.map_densities,(grid,xyz,vdw_rad)))
+
+    # features stored as (chain,x,y,z,value)
+    for feat in molgrp['features'].keys():
+        if feat+'_chainA' in skip and feat+'_chainB' in skip:
+            continue
+        with instrument.phase('hdf5 read'):
+            data = np.asarray(molgrp['features/'+feat][()])
+        if data.size == 0:
+            data = np.zeros((0,5))
+        if data.ndim != 2 or data.shape[1] < 5:
+            raise ValueError('features/%s has the shape %s, (natom,4+nvalues) (chain,x,y,z,values) expected' %(feat,data.shape))
+
+        # one grid per chain and per value as deeprank names them (e.g. PSSM)
+        chain, xyz, nval = data[:,0], data[:,1:4], data.shape[1]-4
+        for ichain,chain_name in enumerate(['A','B']):
+            sel = chain == ichain
+            for ival in range(nval):
+                name = feat + '_chain' + chain_name
+                if nval > 1:
+                    name += '_%03d' %ival
+                if name in skip:
+                    continue
+                jobs.append((name,gridmap.map_values,(grid,xyz[sel],data[sel,4+ival])))
+
+    # map the features in parallel
+    instrument.progress('mapping %d grids' %len(jobs))
+    with instrument.phase('grid mapping'):
+        return gridmap.map_many(jobs,nthreads)
 
-        elif feat_type == 'Features':
-            data = ds.map_feature(feat_names, molgrp, grid, npts, None, None)
+def export_cube_files(data_dict,grid,export_path):
+    export_volume_files(data_dict,grid,export_path,fmt='cube')
 
-            k = 0
-            for feat in feat_names:
-                for chain in ['_chainA', '_chainB']:
-                    data_dict[feat+chain] = data[k]
-                    k+=1
+def export_volume_files(data_dict,grid,export_path,fmt=VOLUME_FORMAT):
 
-    return data_dict
+    print('-- Export data to %s' %(export_path))
+    ext = volformats.FORMATS[fmt]['ext']
 
-def export_cube_files(data_dict,grid,export_path):
+    # data_dict can also be an iterator over (key,values)
+    # so that only one feature is held in memory at a time
+    if isinstance(data_dict,dict):
+        data_dict = data_dict.items()
 
-    print('-- Export data to %s' %(export_path))
-    bohr2ang = 0.52918
+    # export files for visualization
+    for key,values in data_dict:
 
-    # individual axis of the grid
-    x,y,z = grid['x'],grid['y'],grid['z']
+        fname = export_path + '%s' %(key) + ext
+        instrument.progress('export %s' %key)
+        if not os.path.isfile(fname):
+            with instrument.phase('volume write'):
+                volformats.write_volume(fname,values,grid,fmt)
 
-    # extract grid_info
-    npts = np.array([len(x),len(y),len(z)])
-    res = np.array([x[1]-x[0],y[1]-y[0],z[1]-z[0]])
+def write_isosurface_levels(export_path,molgrp,index,lod=1,q=ISO_QUANTILE):
 
-    # the cuve file is apparently give in bohr
-    xmin,ymin,zmin = np.min(x)/bohr2ang,np.min(y)/bohr2ang,np.min(z)/bohr2ang
-    scale_res = res/bohr2ang
+    # levels of the isosurfaces of the exported features from the statistics
+    # of the file at the exported level of detail, only if they are already
+    # built (index.cached), the other features keep the default levels
+    stats = index.cached() if index is not None else None
+    stats = stats.get(lod,{}) if stats is not None else {}
 
-    # export files for visualization
-    for key,values in data_dict.items():
+    # full name of the exported features, the first group wins as in the export
+    names = {}
+    if 'mapped_features' in molgrp:
+        mapgrp = molgrp['mapped_features']
+        for data_name in mapgrp.keys():
+            for ff in mapgrp[data_name].keys():
+                names.setdefault(ff,data_name + '/' + ff)
+
+    levels = {}
+    for f in os.listdir(export_path):
+        feat = f.split('.')[0]
+        if names.get(feat,None) not in stats or feat in levels:
+            continue
+        pos = stats[names[feat]].hist.quantile(q)
+        neg = stats[names[feat]].hist.quantile(1-q)
+        if pos > 0 or neg < 0:
+            pos = pos if pos > 0 else -neg
+            neg = neg if neg < 0 else -pos
+            levels[feat] = [neg,pos]
+
+    with open(os.path.join(export_path,'levels.json'),'w') as f:
+        json.dump(levels,f)
+    return levels
+
+def read_isosurface_levels(export_path):
+    fname = os.path.join(export_path,'levels.json')
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def write_vmd_script(export_path,fmt=VOLUME_FORMAT):
 
-        fname = export_path + '%s' %(key) + '.cube'
-        if not os.path.isfile(fname):
-            f = open(fname,'w')
-            f.write('CUBE FILE\n')
-            f.write("OUTER LOOP: X, MIDDLE LOOP: Y, INNER LOOP: Z\n")
-
-            f.write("%5i %11.6f %11.6f %11.6f\n" %  (1,xmin,ymin,zmin))
-            f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[0],scale_res[0],0,0))
-            f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[1],0,scale_res[1],0))
-            f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[2],0,0,scale_res[2]))
-
-
-            # the cube file require 1 atom
-            f.write("%5i %11.6f %11.6f %11.6f %11.6f\n" %  (0,0,0,0,0))
-
-            last_char_check = True
-            for i in range(npts[0]):
-                for j in range(npts[1]):
-                    for k in range(npts[2]):
-                        f.write(" %11.5e" % values[i,j,k])
-                        last_char_check = True
-                        if k % 6 == 5:
-                            f.write("\n")
-                            last_char_check = False
-                    if last_char_check:
-                        f.write("\n")
-            f.close()
-
-def launchVMD(mol_name, root='./_tmp_h5x/'):
-
-    export_path =  root + mol_name + '/'
     exec_fname = 'loadData.vmd'
+    if 'vmd' not in volformats.FORMATS[fmt]['viewers']:
+        raise ValueError('VMD can not read the %s format' %fmt)
+    ext = volformats.FORMATS[fmt]['ext']
 
-    # export VMD script if cube format is required
+    # export VMD script
     fname = export_path + exec_fname
     f = open(fname,'w')
     f.write('# can be executed with vmd -e loadData.vmd\n\n')
 
-    # write all the cube file in one given molecule
-    cube_files = np.sort(list(filter(lambda x: '.cube' in x,os.listdir(export_path))))
+    # write all the grid files in one given molecule
+    cube_files = np.sort(list(filter(lambda x: x.endswith(ext),os.listdir(export_path))))
 
-    write_molspec_vmd(f, cube_files[0],'IsoSurface','Volume')
+    # all the grids are frames of the same molecule so they share one level
+    levels = read_isosurface_levels(export_path)
+    level = np.median([l[1] for l in levels.values()]) if len(levels) > 0 else ISO_LEVEL_VMD
+    write_molspec_vmd(f, cube_files[0],'IsoSurface','Volume',level=level)
     for idata in range(1,len(cube_files)):
         f.write('mol addfile ' + '%s\n' %(cube_files[idata]))
     f.write('mol rename top grid_data')
@@ -200,6 +334,17 @@ def launchVMD(mol_name, root='./_tmp_h5x/'):
     # close file
     f.close()
 
+    return exec_fname
+
+def launchVMD(export_path,fmt=VOLUME_FORMAT,session=VIEWER_SESSION):
+
+    exec_fname = write_vmd_script(export_path,fmt)
+
+    # load the data in the running VMD
+    if session:
+        get_session('vmd').send(['cd {%s}' %os.path.abspath(export_path),'source %s' %exec_fname])
+        return
+
     # launch VMD
     sw,sh = 1050,600
     w,h = 600,600
@@ -208,10 +353,10 @@ def launchVMD(mol_name, root='./_tmp_h5x/'):
     sp.Popen('vmd ' + vmd_option + vmd_file, cwd = export_path,shell = True)
 
 # quick shortcut for writting the vmd file
-def write_molspec_vmd(f,name,rep,color):
+def write_molspec_vmd(f,name,rep,color,level=ISO_LEVEL_VMD):
     f.write('\nmol new %s\n' %name)
     if rep == 'IsoSurface':
-        f.write('mol delrep 0 top\nmol representation %s 0.02 0.0 0.0 0.0\n' %rep)
+        f.write('mol delrep 0 top\nmol representation %s %g 0.0 0.0 0.0\n' %(rep,level))
     else:
         f.write('mol delrep 0 top\nmol representation %s\n' %rep)
     if color is not None:
@@ -220,11 +365,15 @@ def write_molspec_vmd(f,name,rep,color):
 
 
 
-def launchPyMol(mol_name, root='./_tmp_h5x/'):
+def launchPyMol(export_path,fmt=VOLUME_FORMAT,session=VIEWER_SESSION):
 
+    # load the data in the running PyMol
+    if session:
+        get_session('pymol').send(pymol_commands(export_path,fmt))
+        return
 
-    export_path =  root + mol_name + '/'
     exec_fname = 'loadData.py'
+    ext = volformats.FORMATS[fmt]['ext']
 
     fname = export_path + exec_fname
     f = open(fname,'w')
@@ -239,14 +388,16 @@ def launchPyMol(mol_name, root='./_tmp_h5x/'):
     f.write("pymol.cmd.show('stick','complex')\n\n")
 
     f.write("# load the molecule\n")
-    f.write("cube_files = list(filter(lambda x: '.cube' in x,os.listdir('./')))\n")
+    f.write("cube_files = list(filter(lambda x: x.endswith('%s'),os.listdir('./')))\n" %ext)
+    f.write("levels = %r\n\n" %read_isosurface_levels(export_path))
 
-    # load the cube files
+    # load the grid files
     f.write("for f in cube_files:\n")
-    f.write("   fname = os.path.splitext(f)[0]\n")
-    f.write("   pymol.cmd.load(f)\n")
-    f.write("   pymol.cmd.isosurface('pos_'+fname,fname,level=0.05)\n")
-    f.write("   pymol.cmd.isosurface('neg_'+fname,fname,level=-0.05)\n\n")
+    f.write("   fname = f[:-%d]\n" %len(ext))
+    f.write("   neg,pos = levels.get(fname,(-%g,%g))\n" %(ISO_LEVEL,ISO_LEVEL))
+    f.write("   pymol.cmd.load(f,fname)\n")
+    f.write("   pymol.cmd.isosurface('pos_'+fname,fname,level=pos)\n")
+    f.write("   pymol.cmd.isosurface('neg_'+fname,fname,level=neg)\n\n")
 
     f.write("pymol.cmd.disable('all')\n")
     f.write("pymol.cmd.enable('complex')\n\n")
@@ -254,3 +405,267 @@ def launchPyMol(mol_name, root='./_tmp_h5x/'):
     f.close()
 
     sp.Popen('pymol -qQr ' + exec_fname, cwd = export_path,shell = True)
+
+def pymol_commands(export_path,fmt=VOLUME_FORMAT,name=None):
+
+    # the objects of the molecule are prefixed and grouped by molecule name
+    export_path = os.path.abspath(export_path) + '/'
+    if name is None:
+        name = os.path.basename(export_path.rstrip('/')).rsplit('_',1)[0]
+    ext = volformats.FORMATS[fmt]['ext']
+
+    cmds = []
+    cmds.append('load %scomplex.pdb, %s_complex' %(export_path,name))
+    cmds.append("util.cbc(selection='%s_complex',first_color=7,quiet=1,legacy=0)" %name)
+    cmds.append('show sticks, %s_complex' %name)
+
+    levels = read_isosurface_levels(export_path)
+    for f in sorted(filter(lambda x: x.endswith(ext),os.listdir(export_path))):
+        feat = f[:-len(ext)]
+        obj = '%s_%s' %(name,feat)
+        neg, pos = levels.get(feat,(-ISO_LEVEL,ISO_LEVEL))
+        cmds.append('load %s%s, %s' %(export_path,f,obj))
+        cmds.append('isosurface pos_%s, %s, %g' %(obj,obj,pos))
+        cmds.append('isosurface neg_%s, %s, %g' %(obj,obj,neg))
+
+    members = '%s_* pos_%s_* neg_%s_*' %(name,name,name)
+    cmds.append('group %s, %s' %(name,members))
+    cmds.append('disable %s' %members)
+    cmds.append('enable %s_complex' %name)
+    return cmds
+
+def launch_molecules(export_paths,viewer='pymol',fmt=VOLUME_FORMAT):
+
+    # load several molecules at once in the same running viewer
+    cmds = []
+    if viewer == 'pymol':
+        for p in export_paths:
+            cmds += pymol_commands(p,fmt)
+        # one panel per molecule group
+        cmds.append('set grid_mode, 1')
+    else:
+        for p in export_paths:
+            exec_fname = write_vmd_script(p,fmt)
+            cmds += ['cd {%s}' %os.path.abspath(p),'source %s' %exec_fname]
+    get_session(viewer).send(cmds)
+
+
+class ViewerSession(object):
+
+    default_port = None
+
+    def __init__(self, host='localhost', port=None, start=True, timeout=60):
+        """Control channel to a running viewer.
+
+        The viewer is started the first time commands are sent (unless
+        start=False, e.g. to connect to a server started by hand) and is
+        restarted if it has been closed.
+        """
+
+        self.host = host
+        self.port = port or self.default_port
+        self.start = start
+        self.timeout = timeout
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def alive(self):
+        try:
+            self._ping()
+            return True
+        except (OSError,IOError):
+            return False
+
+    def ensure(self):
+
+        if self.alive():
+            return
+        if not self.start:
+            raise RuntimeError('No viewer listening on %s:%d' %(self.host,self.port))
+
+        print('-- Start %s' %type(self).__name__)
+        self.proc = self._launch()
+        t0 = time.time()
+        while not self.alive():
+            if self.proc.poll() is not None or time.time()-t0 > self.timeout:
+                raise RuntimeError('Could not start %s' %type(self).__name__)
+            time.sleep(0.5)
+
+    def send(self, cmds):
+        with self.lock:
+            self.ensure()
+            return self._send(cmds)
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc = None
+
+
+class PyMolSession(ViewerSession):
+
+    # port of the XML-RPC server started by pymol -R
+    default_port = 9123
+
+    def _proxy(self):
+        return xmlrpc.client.ServerProxy('http://%s:%d' %(self.host,self.port))
+
+    def _launch(self):
+        return sp.Popen(['pymol','-qR'])
+
+    def _ping(self):
+        self._proxy().ping()
+
+    def _send(self, cmds):
+        proxy = self._proxy()
+        return [proxy.do(c) for c in cmds]
+
+
+# Tcl server evaluating one command per line in the running VMD
+VMD_SERVER = """
+proc deepx_accept {chan addr port} {
+    fconfigure $chan -buffering line
+    fileevent $chan readable [list deepx_read $chan]
+}
+proc deepx_read {chan} {
+    if {[eof $chan] || [catch {gets $chan line}]} {
+        close $chan
+        return
+    }
+    if {$line ne ""} {
+        catch {uplevel #0 $line} res
+        puts $chan [string map {"\n" " "} $res]
+    }
+}
+socket -server deepx_accept %d
+"""
+
+class VMDSession(ViewerSession):
+
+    default_port = 5555
+
+    def _launch(self):
+
+        fname = os.path.join(tempfile.gettempdir(),'deepxplorer_vmd_server_%d.tcl' %self.port)
+        with open(fname,'w') as f:
+            f.write(VMD_SERVER %self.port)
+
+        sw,sh = 1050,600
+        w,h = 600,600
+        return sp.Popen(['vmd','-pos',str(sw),str(sh),'-size',str(w),str(h),'-e',fname])
+
+    def _ping(self):
+        self._send(['version'])
+
+    def _send(self, cmds):
+        out = []
+        with socket.create_connection((self.host,self.port),timeout=self.timeout) as sock:
+            f = sock.makefile('rw')
+            for c in cmds:
+                f.write(c + '\n')
+                f.flush()
+                out.append(f.readline().rstrip('\n'))
+        return out
+
+
+# one running session per viewer
+_sessions = {}
+SESSIONS = {'pymol':PyMolSession,'vmd':VMDSession}
+
+def get_session(viewer):
+    if viewer not in _sessions:
+        _sessions[viewer] = SESSIONS[viewer]()
+    return _sessions[viewer]
+
+
+def get_molecule_paths(h5file, patterns=None):
+
+    mol_paths = []
+
+    # walk the tree but do not descend in the molecule groups
+    def _walk(grp):
+        for name in grp.keys():
+            subgrp = grp[name]
+            if not isinstance(subgrp,h5py.Group):
+                continue
+            if subgrp.attrs.get('type',None) == 'molecule':
+                mol_paths.append(subgrp.name)
+            else:
+                _walk(subgrp)
+
+    _walk(h5file)
+
+    # filter the molecules
+    if patterns is not None:
+        mol_paths = [p for p in mol_paths if any(fnmatch.fnmatch(p.split('/')[-1],pat) or fnmatch.fnmatch(p,pat) for pat in patterns)]
+
+    return mol_paths
+
+def _export_molecule(args):
+
+    # each worker opens the file itself
+    fname, mol_path, kwargs = args
+    mol_name = mol_path.split('/')[-1].replace('-','_')
+    try:
+        with instrument.action('Export ' + mol_path,file=fname):
+            with h5py.File(fname,'r') as f5:
+                outdir = create3Ddata(mol_name,f5[mol_path],**kwargs)
+        return mol_path, outdir, None
+    except instrument.Cancelled:
+        raise
+    except Exception as inst:
+        traceback.print_exc()
+        return mol_path, None, '%s : %s' %(type(inst).__name__,inst)
+
+def batch_export(fname, patterns=None, nproc=None, **kwargs):
+
+    with h5py.File(fname,'r') as f5:
+        mol_paths = get_molecule_paths(f5,patterns)
+    print('-- Export %d molecules from %s' %(len(mol_paths),fname))
+
+    root = kwargs.get('root','./_tmp_h5x/')
+    if not os.path.isdir(root):
+        os.makedirs(root,exist_ok=True)
+
+    # one process per molecule so one thread per feature in each of them
+    kwargs.setdefault('nthreads',1)
+
+    # the cache is only evicted at the end, keeping the molecules of this export
+    export_kwargs = dict(kwargs,evict=False)
+
+    failed, outdirs = [], []
+    args = [(fname,p,export_kwargs) for p in mol_paths]
+    with multiprocessing.Pool(nproc) as pool:
+        for mol_path, outdir, error in pool.imap_unordered(_export_molecule,args):
+            if error is None:
+                print('-- Done %s' %mol_path)
+                outdirs.append(outdir)
+            else:
+                print('-- Failed %s (%s)' %(mol_path,error))
+                failed.append(mol_path)
+
+    ExportCache(root,max_size=kwargs.get('cache_size',None)).evict(keep=outdirs)
+    return failed
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Export the PDB and cube files of the molecules of a deeprank HDF5 file')
+    parser.add_argument('hdf5',help='deeprank HDF5 file')
+    parser.add_argument('--mol',nargs='+',default=None,help='only export the molecules matching these patterns (e.g. 1AK4_*)')
+    parser.add_argument('--nproc',type=int,default=None,help='number of worker processes (default: all cores)')
+    parser.add_argument('--root',default='./_tmp_h5x/',help='export directory')
+    parser.add_argument('--cache-size',type=float,default=None,help='disk budget of the export directory in MB')
+    parser.add_argument('--sparse-write',action='store_true',help='write the sparse features without densifying them')
+    parser.add_argument('--npts',type=int,nargs=3,default=[30,30,30],help='number of grid points of the mapped features')
+    parser.add_argument('--res',type=float,nargs=3,default=[1,1,1],help='resolution of the grid of the mapped features')
+    parser.add_argument('--lod',type=int,default=1,help='export a level of detail LOD times coarser (preview)')
+    parser.add_argument('--format',default=VOLUME_FORMAT,choices=sorted(volformats.FORMATS),help='format of the grid files')
+    args = parser.parse_args()
+
+    failed = batch_export(args.hdf5,patterns=args.mol,nproc=args.nproc,root=args.root,
+                          cache_size=args.cache_size,sparse_write=args.sparse_write,
+                          npts=args.npts,res=args.res,fmt=args.format,lod=args.lod)
+    if len(failed) > 0:
+        raise SystemExit(1)
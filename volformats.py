@@ -0,0 +1,196 @@
+import os
+import gzip
+import numpy as np
+
+# formats used to export the grids for the viewers
+# {name : {ext, binary, compress, viewers, write}}
+FORMATS = {}
+
+def register_format(name, ext, write, binary=False, compress=False, viewers=('vmd','pymol')):
+
+    """Add an export format.
+
+    write(f,values,grid) writes the grid values (dense array or sparse
+    FLANgrid) to the opened file f.
+    """
+
+    FORMATS[name] = {'ext':ext,'binary':binary,'compress':compress,'viewers':viewers,'write':write}
+
+def write_volume(fname, values, grid, fmt='cube'):
+
+    spec = FORMATS[fmt]
+    mode = 'wb' if spec['binary'] else 'w'
+    if spec['compress']:
+        mode = mode[0] + ('b' if spec['binary'] else 't')
+        f = gzip.open(fname + '.part',mode,compresslevel=4)
+    else:
+        f = open(fname + '.part',mode)
+
+    # the partial file is removed if the writer fails (or is cancelled)
+    done = False
+    try:
+        spec['write'](f,values,grid)
+        done = True
+    finally:
+        f.close()
+        if not done:
+            os.remove(fname + '.part')
+    os.replace(fname + '.part',fname)
+
+def _dense(values):
+    if hasattr(values,'to_dense'):
+        return values.to_dense()
+    return np.asarray(values)
+
+def _grid_info(grid):
+    x,y,z = grid['x'],grid['y'],grid['z']
+    npts = np.array([len(x),len(y),len(z)])
+    res = np.array([x[1]-x[0],y[1]-y[0],z[1]-z[0]])
+    origin = np.array([np.min(x),np.min(y),np.min(z)])
+    return npts, res, origin
+
+#
+# Gaussian cube
+#
+
+def write_cube(f, values, grid):
+
+    bohr2ang = 0.52918
+    npts, res, origin = _grid_info(grid)
+
+    # the cuve file is apparently give in bohr
+    xmin,ymin,zmin = origin/bohr2ang
+    scale_res = res/bohr2ang
+
+    f.write('CUBE FILE\n')
+    f.write("OUTER LOOP: X, MIDDLE LOOP: Y, INNER LOOP: Z\n")
+
+    f.write("%5i %11.6f %11.6f %11.6f\n" %  (1,xmin,ymin,zmin))
+    f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[0],scale_res[0],0,0))
+    f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[1],0,scale_res[1],0))
+    f.write("%5i %11.6f %11.6f %11.6f\n" %  (npts[2],0,0,scale_res[2]))
+
+
+    # the cube file require 1 atom
+    f.write("%5i %11.6f %11.6f %11.6f %11.6f\n" %  (0,0,0,0,0))
+
+    if hasattr(values,'to_dense'):
+        write_sparse_cube_values(f,values.index,values.value,tuple(npts))
+    else:
+        write_cube_values(f,values)
+
+def _cube_row_format(nz):
+
+    # the cube layout breaks every Z row in lines of 6 values
+    # and closes the row with a line break if it is not full
+    nfull, nrem = divmod(nz,6)
+    row_fmt = (' %11.5e'*6 + '\n')*nfull
+    if nrem > 0:
+        row_fmt += ' %11.5e'*nrem + '\n'
+    return row_fmt
+
+def write_cube_values(f,values,chunk_size=2**20):
+
+    nz = values.shape[-1]
+    row_fmt = _cube_row_format(nz)
+
+    # format blocks of rows at once and write them in one go
+    rows = np.asarray(values).reshape(-1,nz)
+    nrows = max(1,chunk_size//max(1,nz))
+    for istart in range(0,len(rows),nrows):
+        block = rows[istart:istart+nrows]
+        f.write((row_fmt*len(block)) % tuple(block.ravel().tolist()))
+
+def write_sparse_cube_values(f,index,value,shape,chunk_size=2**20):
+
+    nz = shape[-1]
+    row_fmt = _cube_row_format(nz)
+
+    # flat index of the non zero points sorted in the cube order
+    index = np.asarray(index)
+    if index.ndim == 2:
+        index = np.ravel_multi_index(index.T,shape)
+    order = np.argsort(index,kind='stable')
+    index, value = index[order], np.asarray(value)[order]
+
+    # only one block of rows is dense at a time
+    nrows_tot = int(np.prod(shape[:-1]))
+    nrows = max(1,chunk_size//max(1,nz))
+    for istart in range(0,nrows_tot,nrows):
+        iend = min(istart+nrows,nrows_tot)
+        block = np.zeros((iend-istart)*nz,dtype=value.dtype)
+        i0, i1 = np.searchsorted(index,[istart*nz,iend*nz])
+        block[index[i0:i1]-istart*nz] = value[i0:i1]
+        f.write((row_fmt*(iend-istart)) % tuple(block.tolist()))
+
+#
+# CCP4/MRC, 32 bits floats, x fastest
+#
+
+def write_ccp4(f, values, grid):
+
+    values = _dense(values)
+    npts, res, origin = _grid_info(grid)
+
+    header = np.zeros(256,dtype='<i4')
+    fheader = header.view('<f4')
+
+    header[0:3] = npts                   # NC, NR, NS
+    header[3] = 2                        # MODE : float32
+    header[4:7] = 0                      # NCSTART, NRSTART, NSSTART
+    header[7:10] = npts                  # NX, NY, NZ
+    fheader[10:13] = npts*res            # cell dimensions
+    fheader[13:16] = 90.                 # cell angles
+    header[16:19] = [1,2,3]              # MAPC, MAPR, MAPS
+    fheader[19] = np.min(values)
+    fheader[20] = np.max(values)
+    fheader[21] = np.mean(values)
+    header[22] = 1                       # ISPG
+    header[23] = 0                       # NSYMBT
+    fheader[49:52] = origin              # MRC2000 origin
+    header[52:53] = np.frombuffer(b'MAP ',dtype='<i4')
+    header[53:54] = np.frombuffer(b'\x44\x41\x00\x00',dtype='<i4')
+    fheader[54] = np.std(values)
+    f.write(header.tobytes())
+
+    # one section at a time, columns (x) are the fastest
+    for k in range(npts[2]):
+        f.write(np.ascontiguousarray(values[:,:,k].T,dtype='<f4').tobytes())
+
+#
+# OpenDX, z fastest
+#
+
+def write_dx(f, values, grid, chunk_size=2**20):
+
+    values = _dense(values)
+    npts, res, origin = _grid_info(grid)
+
+    f.write('object 1 class gridpositions counts %d %d %d\n' %tuple(npts))
+    f.write('origin %12.6e %12.6e %12.6e\n' %tuple(origin))
+    f.write('delta %12.6e 0 0\n' %res[0])
+    f.write('delta 0 %12.6e 0\n' %res[1])
+    f.write('delta 0 0 %12.6e\n' %res[2])
+    f.write('object 2 class gridconnections counts %d %d %d\n' %tuple(npts))
+    f.write('object 3 class array type double rank 0 items %d data follows\n' %np.prod(npts))
+
+    # 3 values per line
+    data = values.ravel()
+    nline = chunk_size//3
+    for istart in range(0,len(data),3*nline):
+        block = data[istart:istart+3*nline]
+        nfull, nrem = divmod(len(block),3)
+        fmt = '%12.6e %12.6e %12.6e\n'*nfull + ' '.join(['%12.6e']*nrem) + ('\n' if nrem > 0 else '')
+        f.write(fmt % tuple(block.tolist()))
+
+    f.write('attribute "dep" string "positions"\n')
+    f.write('object "regular positions regular connections" class field\n')
+    f.write('component "positions" value 1\n')
+    f.write('component "connections" value 2\n')
+    f.write('component "data" value 3\n')
+
+
+register_format('cube','.cube',write_cube)
+register_format('ccp4','.ccp4',write_ccp4,binary=True)
+register_format('ccp4.gz','.ccp4.gz',write_ccp4,binary=True,compress=True,viewers=('pymol',))
+register_format('dx','.dx',write_dx)
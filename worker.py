@@ -0,0 +1,177 @@
+import itertools
+import multiprocessing
+import threading
+import traceback
+from concurrent import futures
+from PyQt5 import QtCore
+import instrument
+
+def _run_process(tid, channel, flags, state, name, func, *args):
+
+    # runs in the worker process, the progress goes back through the channel
+    # and the task stops at its next progress report once it is cancelled
+    def _report(msg):
+        if flags.get(tid,False):
+            raise instrument.Cancelled(name)
+        channel.put((tid,msg))
+
+    instrument.set_reporter(_report)
+    try:
+        _report('running')
+        return instrument.traced(name,state,func,*args)
+    finally:
+        instrument.set_reporter(None)
+
+class TaskManager(QtCore.QObject):
+
+    # task id, task name, status
+    status = QtCore.pyqtSignal(int,str,str)
+
+    # used to bring the results back in the GUI thread
+    _finished = QtCore.pyqtSignal(object,object)
+
+    def __init__(self, nthreads=None, nprocs=None):
+        """Run the heavy actions of the menu outside of the GUI thread.
+
+        Light tasks (HDF5 reads, metrics) run in a thread pool and the CPU bound
+        ones (grid mapping, cube export) in a process pool. The callback of a task
+        is called in the GUI thread with the result of the task, the done hook
+        with (name,status) whatever the outcome of the task.
+
+        The tasks report their progress with instrument.progress(), sent back
+        from the worker processes through a queue and emitted as status. A
+        running task that is cancelled stops at its next progress report.
+        """
+
+        super().__init__()
+        self.threads = futures.ThreadPoolExecutor(nthreads)
+        self.nprocs = nprocs
+        self.procs = None
+
+        # progress of the process tasks and cancel flags, shared with the workers
+        self.sync = None
+        self.channel = None
+        self.flags = None
+        self.names = {}
+
+        self.tasks = {}
+        self.cancelled = set()
+        self._ids = itertools.count()
+
+        self._finished.connect(self._deliver)
+        self.status.connect(self._print_status)
+
+    def _get_procs(self):
+        # spawn the processes so that they don't inherit the Qt state
+        if self.procs is None:
+            ctx = multiprocessing.get_context('spawn')
+            self.procs = futures.ProcessPoolExecutor(self.nprocs,mp_context=ctx)
+            self.sync = ctx.Manager()
+            self.channel = self.sync.Queue()
+            self.flags = self.sync.dict()
+            threading.Thread(target=self._listen,daemon=True).start()
+        return self.procs
+
+    def _listen(self):
+        # progress of the process tasks, None stops the listener
+        while True:
+            try:
+                msg = self.channel.get()
+            except (EOFError,OSError):
+                return
+            if msg is None:
+                return
+            tid, status = msg
+            if tid in self.tasks:
+                self.status.emit(tid,self.names.get(tid,''),status)
+
+    def submit(self, name, func, *args, callback=None, done=None, process=False):
+
+        tid = next(self._ids)
+        self.names[tid] = name
+        if process:
+            procs = self._get_procs()
+            fut = procs.submit(_run_process,tid,self.channel,self.flags,instrument.settings(),name,func,*args)
+        else:
+            fut = self.threads.submit(self._run,tid,name,func,*args)
+
+        self.tasks[tid] = (name,fut)
+        self.status.emit(tid,name,'queued')
+        fut.add_done_callback(lambda f: self._done(tid,name,f,callback,done))
+        return tid
+
+    def _run(self, tid, name, func, *args):
+
+        def _report(msg):
+            if tid in self.cancelled:
+                raise instrument.Cancelled(name)
+            self.status.emit(tid,name,msg)
+
+        instrument.set_reporter(_report)
+        try:
+            _report('running')
+            with instrument.action(name):
+                return func(*args)
+        finally:
+            instrument.set_reporter(None)
+
+    def _done(self, tid, name, fut, callback, done=None):
+
+        # called from the worker threads
+        self.tasks.pop(tid,None)
+        self.names.pop(tid,None)
+        if self.flags is not None:
+            self.flags.pop(tid,None)
+
+        if fut.cancelled() or tid in self.cancelled or isinstance(fut.exception(),instrument.Cancelled):
+            self.cancelled.discard(tid)
+            self.status.emit(tid,name,'cancelled')
+            if done is not None:
+                self._finished.emit(done,(name,'cancelled'))
+            return
+
+        exc = fut.exception()
+        if exc is not None:
+            self.status.emit(tid,name,'failed (%s : %s)' %(type(exc).__name__,exc))
+            traceback.print_exception(type(exc),exc,exc.__traceback__)
+            if done is not None:
+                self._finished.emit(done,(name,'failed'))
+            return
+
+        self.status.emit(tid,name,'done')
+        if callback is not None:
+            self._finished.emit(callback,fut.result())
+        if done is not None:
+            self._finished.emit(done,(name,'done'))
+
+    def _deliver(self, callback, result):
+        callback(result)
+
+    @staticmethod
+    def _print_status(tid, name, status):
+        print('-- Task %d %s : %s' %(tid,name,status))
+
+    def pending(self):
+        return len(self.tasks)
+
+    def cancel(self, tid):
+        # queued tasks are removed, the running ones stop at their next
+        # progress report and their results are discarded
+        if tid in self.tasks:
+            _, fut = self.tasks[tid]
+            if not fut.cancel():
+                self.cancelled.add(tid)
+                if self.flags is not None:
+                    self.flags[tid] = True
+
+    def cancel_all(self):
+        for tid in list(self.tasks.keys()):
+            self.cancel(tid)
+
+    def shutdown(self):
+        self.cancel_all()
+        self.threads.shutdown(wait=False)
+        if self.procs is not None:
+            self.procs.shutdown(wait=False)
+            self.channel.put(None)
+            self.sync.shutdown()